@@ -0,0 +1,230 @@
+"""Benchmarks for the handlers' hot paths.
+
+Each benchmark emits records through a handler and reports its throughput,
+the latency percentiles of batches of emits (divided by the batch size) and
+the peak memory allocated while it ran, as JSON::
+
+    $ python benchmarks.py --output results.json
+    $ python benchmarks.py --baseline results.json --tolerance 0.2
+
+With *--baseline*, each benchmark's throughput is compared with the stored
+results and the script exits with status 1 if any benchmark is slower than
+the baseline by more than *--tolerance*.
+"""
+
+import json
+import logging
+import optparse
+import platform
+import sys
+import threading
+import time
+import tracemalloc
+
+import statzlogger
+
+class Record(object):
+    """A minimal stand-in for a LogRecord."""
+
+    def __init__(self, msg, **extra):
+        self.msg = msg
+        self.levelno = logging.INFO
+        self.created = time.time()
+        self.__dict__.update(extra)
+
+def percentile(samples, q):
+    """Return the *q* quantile of a sorted list of samples."""
+    return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+def emitter(records, batch=100):
+    """Return an action that handles *records*, timing each batch."""
+    def action(handler):
+        samples = []
+        for offset in range(0, len(records), batch):
+            chunk = records[offset:offset + batch]
+            began = time.perf_counter()
+            for record in chunk:
+                handler.handle(record)
+            samples.append((time.perf_counter() - began) / len(chunk))
+        return samples
+    return action
+
+def measure(name, factory, action, count):
+    """Run *action* on handlers built by *factory*; return the results.
+
+    The action is run twice, on fresh handlers: once to time it, and once
+    under :mod:`tracemalloc` to find its peak memory use.
+    """
+    start = time.perf_counter()
+    samples = action(factory())
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    action(factory())
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    samples.sort()
+    return dict(
+        name=name,
+        count=count,
+        seconds=elapsed,
+        throughput=count / elapsed,
+        latency=dict((key, percentile(samples, q)) for key, q in
+            (("p50", 0.5), ("p90", 0.9), ("p99", 0.99))),
+        peak=peak,
+    )
+
+def single_index(count):
+    records = [Record(i, index="a") for i in range(count)]
+    return measure("sum-single-index", statzlogger.Sum, emitter(records),
+        count)
+
+def multi_index(count):
+    records = [Record(i, indices=["a", "b", "c", "d"], index="e")
+        for i in range(count)]
+    return measure("sum-multi-index", statzlogger.Sum, emitter(records),
+        count)
+
+def counter(count):
+    def action(handler):
+        add = handler.counter("a")
+        samples = []
+        for offset in range(0, count, 100):
+            began = time.perf_counter()
+            for i in range(100):
+                add()
+            samples.append((time.perf_counter() - began) / 100)
+        return samples
+    return measure("sum-counter", statzlogger.Sum, action, count)
+
+def large_maximum(count):
+    records = [Record(i, index="a", weight=(i * 7919) % count)
+        for i in range(count)]
+    return measure("maximum-large-index",
+        lambda: statzlogger.Maximum(size=1000), emitter(records), count)
+
+def large_set(count):
+    records = [Record(i, index="a") for i in range(count)]
+    return measure("set-large-index", statzlogger.Set, emitter(records), count)
+
+def many_indices(count):
+    records = [Record(1, index=i) for i in range(count)]
+    return measure("sum-many-indices", statzlogger.Sum, emitter(records),
+        count)
+
+def summary(count):
+    records = [Record(float(i), index=i % 100) for i in range(count)]
+    return measure("summary", statzlogger.Summary, emitter(records), count)
+
+def top(count):
+    records = [Record(i % 1000, index="a") for i in range(count)]
+    return measure("top", lambda: statzlogger.Top(size=100), emitter(records),
+        count)
+
+def contention(count, threads=4, wrapper=None):
+    """Log through a real Logger from several threads at once."""
+    per = count // threads
+    name = "logger-%d-threads" % threads
+    if wrapper is not None:
+        name += "-" + wrapper.__name__.lower()
+
+    def factory():
+        handler = statzlogger.Sum()
+        if wrapper is not None:
+            handler = wrapper(handler)
+        return handler
+
+    def action(handler):
+        logger = logging.getLogger("statzlogger.benchmarks." + name)
+        logger.propagate = False
+        logger.setLevel(logging.INFO)
+        logger.addHandler(handler)
+        samples = []
+        lock = threading.Lock()
+
+        def work():
+            local = []
+            for offset in range(0, per, 100):
+                began = time.perf_counter()
+                for i in range(100):
+                    logger.info(1, extra=dict(index="a"))
+                local.append((time.perf_counter() - began) / 100)
+            with lock:
+                samples.extend(local)
+
+        workers = [threading.Thread(target=work) for i in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        logger.removeHandler(handler)
+        handler.close()
+        return samples
+
+    return measure(name, factory, action, per * threads)
+
+benchmarks = [
+    single_index,
+    multi_index,
+    counter,
+    large_maximum,
+    large_set,
+    many_indices,
+    summary,
+    top,
+    contention,
+    lambda count: contention(count, wrapper=statzlogger.Sharded),
+    lambda count: contention(count, wrapper=statzlogger.Queued),
+]
+
+def compare(results, baseline, tolerance):
+    """Return the names of benchmarks slower than *baseline*."""
+    previous = dict((item["name"], item) for item in baseline["results"])
+    regressions = []
+    for item in results:
+        old = previous.get(item["name"])
+        if old is None:
+            continue
+        change = item["throughput"] / old["throughput"] - 1
+        item["change"] = change
+        if change < -tolerance:
+            regressions.append(item["name"])
+    return regressions
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("-n", "--count", type="int", default=100000,
+        help="records per benchmark")
+    parser.add_option("-o", "--output", help="write the results to a file")
+    parser.add_option("-b", "--baseline", help="compare with stored results")
+    parser.add_option("-t", "--tolerance", type="float", default=0.1,
+        help="allowed throughput loss against the baseline")
+    options, args = parser.parse_args(argv)
+
+    results = [benchmark(options.count) for benchmark in benchmarks]
+    report = dict(
+        python=platform.python_version(),
+        platform=platform.platform(),
+        count=options.count,
+        results=results,
+    )
+    regressions = []
+    if options.baseline:
+        with open(options.baseline) as fileobj:
+            regressions = compare(results, json.load(fileobj),
+                options.tolerance)
+        report["regressions"] = regressions
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, "w") as fileobj:
+            fileobj.write(output + "\n")
+    else:
+        print(output)
+    for name in regressions:
+        sys.stderr.write("regression: %s\n" % name)
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
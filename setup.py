@@ -1,5 +1,3 @@
-import sys
-
 from setuptools import setup
 
 meta = dict(
@@ -11,6 +9,7 @@ meta = dict(
     py_modules=["statzlogger"],
     test_suite="tests",
     install_requires=["setuptools"],
+    python_requires=">=3.7",
     keywords="logging statistics sawzall szl",
     url="http://packages.python.org/statzlogger",
     classifiers=[
@@ -20,14 +19,9 @@ meta = dict(
         "License :: OSI Approved :: MIT License",
         "Natural Language :: English",
         "Programming Language :: Python",
+        "Programming Language :: Python :: 3",
         "Topic :: System :: Logging",
     ],
 )
 
-# Automatic conversion for Python 3 requires distribute.
-if False and sys.version_info >= (3,):
-    meta.update(dict(
-        use_2to3=True,
-    ))
-
 setup(**meta)
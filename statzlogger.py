@@ -14,10 +14,43 @@ ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
 OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 """
 
+import collections
+import array
+import asyncio
+import copy
+import functools
+import hashlib
+import heapq
+import io
+import itertools
+import json
 import logging
+import math
+import mmap
+import multiprocessing
+import multiprocessing.connection
 import operator
+import os
+import random
+import re
+import socket
+import struct
+import sys
+import threading
+import time
 
-__all__ = ["StatzHandler", "Sum", "Collection", "Maximum", "Minimum", "Set"]
+import queue
+from collections.abc import Mapping, MutableMapping
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+__all__ = ["StatzHandler", "Sum", "Collection", "Maximum", "Minimum", "Set",
+    "Sample", "Sampler", "Top", "Unique", "Quantile", "Summary", "Queued",
+    "Async", "Sharded", "Window", "Shipper", "Collector", "Exporter",
+    "FileSink", "StatsdSink"]
 
 try:
     NullHandler = logging.NullHandler
@@ -29,158 +62,3606 @@ except AttributeError:
 log = logging.getLogger("statzlogger")
 log.addHandler(NullHandler())
 
-class StatzHandler(logging.Handler):
-    """A basic handler to receive statistics in the form of LogRecords.
+class Indices(Mapping):
+    """A read-only view of a handler's aggregated indices.
 
-    The StatzHandler knows how to index and aggregate LogRecords. Various
-    subclasses may aggregate records differently, but they all maintain a
-    *indices* attribute. *indices* is a dictionary with keys accumulated during
-    a logging run; its values are the logged data aggregated by index.
+    Handlers may store each index in an internal form (a heap, for example).
+    The view converts an index to its public form with the handler's
+    :meth:`StatzHandler.readvalue` only when that index is read.
+    """
 
-    These handlers rely on extra information supplied when a LogRecord is
-    created (see :meth:`getvalue`). Instantiation of a StatzHandler is no
-    different from that of a normal Handler.
+    def __init__(self, data, readvalue):
+        self.data = data
+        self.readvalue = readvalue
+
+    def __getitem__(self, index):
+        return self.readvalue(self.data[index])
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, index):
+        return index in self.data
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+class _Reversed(object):
+    """Invert the ordering of a weight."""
+    __slots__ = ("weight",)
+
+    def __init__(self, weight):
+        self.weight = weight
+
+    def __eq__(self, other):
+        return self.weight == other.weight
+
+    def __lt__(self, other):
+        return other.weight < self.weight
+
+    def __gt__(self, other):
+        return other.weight > self.weight
+
+class BoundedHeap(object):
+    """The *size* heaviest (value, weight) pairs seen so far.
+
+    The pairs are kept in a min-heap whose root is the pair that would be
+    dropped next, so adding a pair costs O(log size). If *reverse* is false,
+    the lightest pairs are kept instead. Pairs with equal weights keep the
+    order in which they were pushed. Since every entry carries a unique
+    sequence number, values themselves are never compared.
+    """
+    __slots__ = ("size", "reverse", "heap", "count")
+
+    def __init__(self, size=None, reverse=True):
+        self.size = size
+        self.reverse = reverse
+        self.heap = []
+        self.count = 0
+
+    def push(self, value, weight):
+        """Add a pair, dropping the lightest pair if the heap is full."""
+        self.count += 1
+        key = weight if self.reverse else _Reversed(weight)
+        entry = (key, -self.count, value, weight)
+        heap = self.heap
+        if self.size is None or len(heap) < self.size:
+            heapq.heappush(heap, entry)
+        elif heap and entry > heap[0]:
+            heapq.heapreplace(heap, entry)
+
+    def items(self):
+        """Return a list of (value, weight) pairs, heaviest first."""
+        entries = sorted(self.heap, reverse=True)
+        return [(value, weight) for _, _, value, weight in entries]
+
+    def extend(self, pairs):
+        """Push many pairs at once.
+
+        The result is the same as pushing each pair in turn, but the heap
+        is rebuilt only once.
+        """
+        entries = self.heap
+        for value, weight in pairs:
+            self.count += 1
+            key = weight if self.reverse else _Reversed(weight)
+            entries.append((key, -self.count, value, weight))
+        if self.size is not None and len(entries) > self.size:
+            entries = heapq.nlargest(self.size, entries)
+        heapq.heapify(entries)
+        self.heap = entries
+
+    def merge(self, other):
+        """Push every pair kept by *other*."""
+        for value, weight in other.items():
+            self.push(value, weight)
+
+    def dump(self):
+        """Return the heap as a list of (value, weight, sequence) triples."""
+        return [(value, weight, -seq) for _, seq, value, weight in self.heap]
+
+    @classmethod
+    def load(cls, triples, size=None, reverse=True):
+        """Return a heap from the output of :meth:`dump`."""
+        heap = cls(size, reverse)
+        for value, weight, seq in triples:
+            key = weight if reverse else _Reversed(weight)
+            heap.heap.append((key, -seq, value, weight))
+            heap.count = max(heap.count, seq)
+        heapq.heapify(heap.heap)
+        return heap
+
+    def __copy__(self):
+        new = BoundedHeap(self.size, self.reverse)
+        new.heap = list(self.heap)
+        new.count = self.count
+        return new
+
+    def __len__(self):
+        return len(self.heap)
+
+def floatweight(weight):
+    """Return *weight* as a float, or raise TypeError if it can't be one.
+
+    Only floats (other than NaN) and ints between -2 ** 53 and 2 ** 53 are
+    accepted: a float holds them exactly, and they read back as the same
+    type. Other weights, even ones equal to a float (such as a Fraction or
+    True), are refused.
     """
-    indices = {}
-    """A dictionary of indices.
+    kind = type(weight)
+    if kind is float and weight == weight:
+        return weight
+    if kind is int and -2 ** 53 <= weight <= 2 ** 53:
+        return float(weight)
+    raise TypeError("weight %r is not a float" % (weight,))
+
+class BoundedArray(object):
+    """The *size* heaviest (value, weight) pairs, in parallel arrays.
 
-    :meth:`emit` stores new record values after determining the appropriate
-    index for a record (see :meth:`getindices`).
+    This keeps the same pairs as :class:`BoundedHeap` (ties included), but
+    stores each entry as a double in *keys* (the weight, negated if
+    *reverse* is false), a sequence number in *seqs*, a flag in *ints* that
+    is set if the weight was an integer (so it is read back as one) and the
+    value in *values*, about a fifth of the memory of a tuple per entry. New
+    pairs are appended until there are twice *size* of them, when the
+    heaviest *size* are kept; pairs no heavier than the lightest kept one
+    are dropped at once. Weights must be floats or ints a float holds exactly
+    (see :func:`floatweight`); :meth:`push` raises TypeError otherwise.
+
+    Equal keys always appear in the arrays in the order they were pushed,
+    so a stable sort on the keys alone gives the order of the pairs.
     """
+    __slots__ = ("size", "reverse", "keys", "seqs", "ints", "values", "count",
+        "threshold")
 
-    def __init__(self, level=logging.NOTSET):
-        logging.Handler.__init__(self, level=level)
-        self.indices = {}
+    def __init__(self, size=None, reverse=True):
+        self.size = size
+        self.reverse = reverse
+        self.keys = array.array("d")
+        self.seqs = array.array("q")
+        self.ints = array.array("b")
+        self.values = []
+        self.count = 0
+        self.threshold = None
 
-    def getindices(self, record):
-        """Return a list of indices for a given record.
+    def push(self, value, weight):
+        """Add a pair, dropping the lightest pairs if there are too many."""
+        key = floatweight(weight)
+        if not self.reverse:
+            key = -key
+        self.count += 1
+        if self.threshold is not None and key <= self.threshold:
+            return
+        self.keys.append(key)
+        self.seqs.append(self.count)
+        self.ints.append(type(weight) is int)
+        self.values.append(value)
+        if self.size is not None and len(self.values) >= 2 * self.size:
+            self.compact()
 
-        The list of indices will either contain the record's *index* attribute
-        or a list generated from its iterable *indices* attribute. If both
-        attributes are present, *index* will be added to *indices*. If no
-        indices are defined, the resulting list will be [None].
+    def extend(self, pairs):
+        """Push many pairs at once."""
+        for value, weight in pairs:
+            self.push(value, weight)
+
+    def order(self):
+        """Return the positions of the kept pairs, heaviest first."""
+        keys = self.keys
+        order = sorted(range(len(keys)), key=keys.__getitem__, reverse=True)
+        return order[:self.size]
+
+    def compact(self):
+        """Drop every pair but the *size* heaviest."""
+        order = self.order()
+        keys, seqs, ints, values = self.keys, self.seqs, self.ints, self.values
+        self.keys = array.array("d", [keys[i] for i in order])
+        self.seqs = array.array("q", [seqs[i] for i in order])
+        self.ints = array.array("b", [ints[i] for i in order])
+        self.values = [values[i] for i in order]
+        if len(order) == self.size:
+            self.threshold = self.keys[-1] if order else float("inf")
+
+    def weight(self, i):
+        """Return the weight of the pair at position *i*."""
+        key = self.keys[i]
+        if not self.reverse:
+            key = -key
+        if self.ints[i]:
+            return int(key)
+        return key
+
+    def items(self):
+        """Return a list of (value, weight) pairs, heaviest first."""
+        values = self.values
+        return [(values[i], self.weight(i)) for i in self.order()]
+
+    def merge(self, other):
+        """Push every pair kept by *other*.
+
+        Raise TypeError, leaving this array alone, if any of *other*'s
+        weights isn't a float.
         """
-        index = getattr(record, "index", None)
-        indices = list(getattr(record, "indices", []))
-        if index is not None:
-            indices.append(index)
-        if not indices:
-            indices = [None]
+        pairs = other.items()
+        for _, weight in pairs:
+            floatweight(weight)
+        self.extend(pairs)
 
-        return indices
+    def dump(self):
+        """Return the pairs as a list of (value, weight, sequence) triples."""
+        seqs, values = self.seqs, self.values
+        return [(values[i], self.weight(i), seqs[i]) for i in self.order()]
 
-    def getvalue(self, record):
-        """Return the value of a LogRecord instance.
+    @classmethod
+    def load(cls, triples, size=None, reverse=True):
+        """Return an array from the output of :meth:`dump`."""
+        new = cls(size, reverse)
+        for value, weight, seq in sorted(triples, key=operator.itemgetter(2)):
+            new.count = seq - 1
+            new.push(value, weight)
+        return new
 
-        If *record* has a *value* attribute, use that. Otherwise, use its *msg*
-        attribute. Note: LogRecords can be given (nearly) arbitrary attributes
-        at creation time by passing the *extra* keyword argument to the logging
-        method. For example::
+    def widen(self):
+        """Return a :class:`BoundedHeap` holding the same pairs."""
+        heap = BoundedHeap.load(self.dump(), self.size, self.reverse)
+        heap.count = self.count
+        return heap
 
-            >>> logging.debug("a message", extra={"value": "the real value"})
+    def __copy__(self):
+        new = BoundedArray(self.size, self.reverse)
+        new.keys = array.array("d", self.keys)
+        new.seqs = array.array("q", self.seqs)
+        new.ints = array.array("b", self.ints)
+        new.values = list(self.values)
+        new.count = self.count
+        new.threshold = self.threshold
+        return new
+
+    def __len__(self):
+        if self.size is None:
+            return len(self.values)
+        return min(len(self.values), self.size)
+
+class StreamSummary(object):
+    """Approximate counts of the most frequent values in a stream.
+
+    This is the Space-Saving algorithm: at most *size* values are counted.
+    When a new value arrives and the summary is full, the value with the
+    lowest count is replaced and the newcomer inherits that count as its
+    error. Any value whose true count exceeds *total* / *size* is present,
+    and each count overestimates the true count by at most its error.
+
+    Weights must be positive. The lowest counter is found with a lazily
+    updated heap, so adding a value costs O(log size) at worst.
+    """
+    __slots__ = ("size", "counts", "errors", "heap", "total", "seq")
+
+    def __init__(self, size):
+        if size < 1:
+            raise ValueError("size must be at least 1")
+        self.size = size
+        self.counts = {}
+        self.errors = {}
+        self.heap = []
+        self.total = 0
+        self.seq = 0
+
+    def add(self, value, weight=1):
+        """Count *value* *weight* times."""
+        self.total += weight
+        counts = self.counts
+        if value in counts:
+            counts[value] += weight
+            return
+        if len(counts) < self.size:
+            counts[value] = weight
+            self.errors[value] = 0
+        else:
+            floor, old = self.popmin()
+            del counts[old], self.errors[old]
+            counts[value] = floor + weight
+            self.errors[value] = floor
+        self.seq += 1
+        heapq.heappush(self.heap, (counts[value], self.seq, value))
+
+    def popmin(self):
+        """Remove the heap entry of the least frequent value.
+
+        Heap entries are not updated when a count grows, so stale entries
+        are refreshed as they reach the root. Return (count, value).
         """
-        return getattr(record, "value", record.msg)
+        heap = self.heap
+        counts = self.counts
+        while True:
+            count, _, value = heap[0]
+            current = counts[value]
+            if current == count:
+                heapq.heappop(heap)
+                return count, value
+            self.seq += 1
+            heapq.heapreplace(heap, (current, self.seq, value))
 
-    def emit(self, record):
-        """Emit the record.
+    def items(self):
+        """Return a list of (value, count) pairs, most frequent first."""
+        return sorted(self.counts.items(), key=operator.itemgetter(1),
+            reverse=True)
 
-        Typically, this means aggregating it in one of the handler's indices
-        (under :attr:`indices`).
+    def bounds(self):
+        """Return a list of (value, lower, upper) count bounds."""
+        errors = self.errors
+        return [(value, count - errors[value], count)
+            for value, count in self.items()]
+
+    def floor(self):
+        """Return the count an untracked value may have had."""
+        if len(self.counts) < self.size:
+            return 0
+        return min(self.counts.values())
+
+    def merge(self, other):
+        """Fold the counts of *other* into this summary.
+
+        Values missing from one summary are assumed to have its *floor*
+        count; the *size* largest combined counts are kept.
         """
-        for index in self.getindices(record):
-            value = self.getvalue(record)
-            self.emitvalue(value, index)
+        floor, otherfloor = self.floor(), other.floor()
+        counts, errors = {}, {}
+        for value in set(self.counts).union(other.counts):
+            counts[value] = (self.counts.get(value, floor) +
+                other.counts.get(value, otherfloor))
+            errors[value] = (self.errors.get(value, floor) +
+                other.errors.get(value, otherfloor))
+        keep = heapq.nlargest(self.size, counts, key=counts.get)
+        self.counts = dict((value, counts[value]) for value in keep)
+        self.errors = dict((value, errors[value]) for value in keep)
+        self.total += other.total
+        self.rebuild()
 
-    def emitvalue(self, value, index):
-        """Emit a value for a single index."""
-        self.indices[index] = value
+    def rebuild(self):
+        """Rebuild the heap from the current counts."""
+        self.seq = 0
+        self.heap = []
+        for value, count in self.counts.items():
+            self.seq += 1
+            self.heap.append((count, self.seq, value))
+        heapq.heapify(self.heap)
 
-class Sum(StatzHandler):
-    """The arithmetic sum of the value of each record.
+    def dump(self):
+        """Return the summary as (size, total, [(value, count, error)])."""
+        return (self.size, self.total, [(value, count, self.errors[value])
+            for value, count in self.counts.items()])
 
-    Doesn't make sense for eg string values, but the implementation won't
-    complain. Parameters:
+    @classmethod
+    def load(cls, state):
+        """Return a summary from the output of :meth:`dump`."""
+        size, total, counters = state
+        summary = cls(size)
+        for value, count, error in counters:
+            summary.counts[value] = count
+            summary.errors[value] = error
+        summary.total = total
+        summary.rebuild()
+        return summary
 
-        * *default* starting value
-        * *op* operator to add values together
+    def __copy__(self):
+        new = StreamSummary(self.size)
+        new.counts = dict(self.counts)
+        new.errors = dict(self.errors)
+        new.heap = list(self.heap)
+        new.total = self.total
+        new.seq = self.seq
+        return new
+
+    def __len__(self):
+        return len(self.counts)
+
+def hashvalue(value):
+    """Return a 64 bit hash of *value* that is stable across processes.
+
+    Strings and bytes are hashed directly; other values are hashed by their
+    :func:`repr`.
     """
+    if isinstance(value, bytes):
+        data = b"b" + value
+    elif isinstance(value, str):
+        data = b"s" + value.encode("utf-8")
+    else:
+        data = b"r" + repr(value).encode("utf-8")
+    return struct.unpack(">Q", hashlib.sha1(data).digest()[:8])[0]
 
-    def __init__(self, level=logging.NOTSET, default=0, op=operator.add):
-        StatzHandler.__init__(self, level=level)
-        self.default = default
-        self.op = op
+FORMAT = b"SZL"
+"""The magic bytes that start a stream of encoded indices."""
 
-    def emitvalue(self, value, index):
-        value = self.op(self.indices.setdefault(index, self.default), value)
-        StatzHandler.emitvalue(self, value, index)
+FORMAT_VERSION = 1
+"""The version of the encoding written by :func:`dumpstream`."""
 
-class Collection(Sum):
-    """A collection of records values."""
+def writevarint(write, number):
+    """Write a non-negative integer in 7 bit groups."""
+    while number > 0x7f:
+        write(struct.pack("B", (number & 0x7f) | 0x80))
+        number >>= 7
+    write(struct.pack("B", number))
 
-    def __init__(self, level=logging.NOTSET, default=[], op=operator.add):
-        Sum.__init__(self, level=level, default=default, op=op)
+def readvarint(read):
+    """Read an integer written by :func:`writevarint`."""
+    number = shift = 0
+    while True:
+        byte = read(1)
+        if not byte:
+            raise EOFError("truncated stream")
+        byte = ord(byte)
+        number |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return number
+        shift += 7
 
-    def getvalue(self, record):
-        return [Sum.getvalue(self, record)]
+def readexact(read, size):
+    """Read exactly *size* bytes with *read*; raise EOFError if cut short."""
+    data = read(size)
+    if len(data) != size:
+        raise EOFError("truncated stream")
+    return data
 
-class Maximum(Collection):
-    """Keep only the values with the highest weight.
+_containers = ((tuple, b"t"), (list, b"l"), (set, b"S"), (frozenset, b"z"))
 
-    In addition to the usual *msg* or *value* attributes, a LogRecord may set a
-    *weight* attribute to influence the record's place in the sorted collection.
-    Parameters:
+def encode(value, write):
+    """Write a compact, tagged encoding of *value* with *write*.
 
-        * *size* maximum size of each index
-        * *weight* default record weight
-        * *reverse* direction in which to sort the collection
+    Supported values are None, booleans, integers, floats, strings, bytes,
+    and tuples, lists, sets, frozensets and dictionaries of supported
+    values. Anything else raises :exc:`TypeError`; unlike :mod:`pickle`,
+    decoding never runs code.
+    """
+    if value is None:
+        write(b"N")
+    elif value is True:
+        write(b"T")
+    elif value is False:
+        write(b"F")
+    elif isinstance(value, int):
+        write(b"i")
+        writevarint(write, value << 1 if value >= 0 else ((-value) << 1) - 1)
+    elif isinstance(value, float):
+        write(b"f" + struct.pack(">d", value))
+    elif isinstance(value, str):
+        data = value.encode("utf-8")
+        write(b"s")
+        writevarint(write, len(data))
+        write(data)
+    elif isinstance(value, (bytes, bytearray)):
+        write(b"b")
+        writevarint(write, len(value))
+        write(bytes(value))
+    elif isinstance(value, dict):
+        write(b"d")
+        writevarint(write, len(value))
+        for key, item in value.items():
+            encode(key, write)
+            encode(item, write)
+    else:
+        for cls, tag in _containers:
+            if isinstance(value, cls):
+                break
+        else:
+            raise TypeError("cannot encode %r" % (value,))
+        write(tag)
+        writevarint(write, len(value))
+        for item in value:
+            encode(item, write)
+
+def decode(read):
+    """Read one value written by :func:`encode` with *read*."""
+    tag = read(1)
+    if tag == b"N":
+        return None
+    elif tag == b"T":
+        return True
+    elif tag == b"F":
+        return False
+    elif tag == b"i":
+        number = readvarint(read)
+        return number >> 1 if not number & 1 else -((number + 1) >> 1)
+    elif tag == b"f":
+        return struct.unpack(">d", readexact(read, 8))[0]
+    elif tag == b"s":
+        return readexact(read, readvarint(read)).decode("utf-8")
+    elif tag == b"b":
+        return readexact(read, readvarint(read))
+    elif tag == b"d":
+        items = []
+        for i in range(readvarint(read)):
+            key = decode(read)
+            items.append((key, decode(read)))
+        return dict(items)
+    for cls, containertag in _containers:
+        if tag == containertag:
+            return cls([decode(read) for i in range(readvarint(read))])
+    if not tag:
+        raise EOFError("truncated stream")
+    raise ValueError("unknown tag %r" % tag)
+
+def dumpstream(fileobj, kind, items):
+    """Write a stream of encoded indices to *fileobj*.
+
+    The stream starts with :data:`FORMAT`, :data:`FORMAT_VERSION` and the
+    *kind* of handler that wrote it, followed by one record for each
+    (index, value) pair in *items* and an end marker. Values must already
+    be in an encodable form (see :meth:`StatzHandler.dumpvalue`).
+    """
+    write = fileobj.write
+    write(FORMAT + struct.pack("B", FORMAT_VERSION))
+    encode(kind, write)
+    for index, value in items:
+        write(b"R")
+        encode(index, write)
+        encode(value, write)
+    write(b"E")
+
+def readstream(fileobj):
+    """Read the header of a stream written by :func:`dumpstream`.
+
+    Return the stream's kind and an iterator that decodes its (index,
+    value) records one at a time, so that a stream can be merged without
+    loading it all in memory.
+    """
+    read = fileobj.read
+    header = readexact(read, len(FORMAT) + 1)
+    if header[:len(FORMAT)] != FORMAT:
+        raise ValueError("not a statzlogger stream")
+    version = ord(header[len(FORMAT):])
+    if version != FORMAT_VERSION:
+        raise ValueError("unsupported stream version %d" % version)
+    kind = decode(read)
+
+    def records():
+        while True:
+            marker = read(1)
+            if marker == b"E":
+                return
+            if not marker:
+                raise EOFError("truncated stream")
+            if marker != b"R":
+                raise ValueError("corrupt stream")
+            index = decode(read)
+            yield index, decode(read)
+
+    return kind, records()
+
+class HyperLogLog(object):
+    """An estimate of the number of distinct values in a stream.
+
+    The estimator uses 2 ** *precision* one-byte registers, so its memory is
+    fixed no matter how many values are added. Its standard error is about
+    1.04 / sqrt(2 ** *precision*). Two estimators with the same precision can
+    be merged with :meth:`merge`.
+
+    The sum of 2 ** -register over the registers (*harmonic*) and the number
+    of zero registers (*zeros*) are kept up to date as registers change, so
+    :meth:`estimate` costs O(1).
+    """
+    __slots__ = ("precision", "registers", "harmonic", "zeros")
+
+    def __init__(self, precision=12):
+        if not 4 <= precision <= 16:
+            raise ValueError("precision must be between 4 and 16")
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+        self.harmonic = float(len(self.registers))
+        self.zeros = len(self.registers)
+
+    def add(self, value):
+        """Add *value* to the stream."""
+        x = hashvalue(value)
+        bits = 64 - self.precision
+        register = x >> bits
+        rank = bits - (x & ((1 << bits) - 1)).bit_length() + 1
+        current = self.registers[register]
+        if rank > current:
+            self.registers[register] = rank
+            self.harmonic += 2.0 ** -rank - 2.0 ** -current
+            if not current:
+                self.zeros -= 1
+
+    def recount(self):
+        """Recompute *harmonic* and *zeros* from the registers."""
+        self.harmonic = math.fsum(2.0 ** -r for r in self.registers)
+        self.zeros = self.registers.count(0)
+
+    def merge(self, other):
+        """Fold the registers of *other* into this estimator."""
+        if other.precision != self.precision:
+            raise ValueError("cannot merge estimators of different precision")
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        self.recount()
+
+    def dump(self):
+        """Return the estimator as (precision, registers)."""
+        return (self.precision, bytes(self.registers))
+
+    @classmethod
+    def load(cls, state):
+        """Return an estimator from the output of :meth:`dump`."""
+        precision, registers = state
+        estimator = cls(precision)
+        estimator.registers = bytearray(registers)
+        estimator.recount()
+        return estimator
+
+    def __copy__(self):
+        new = HyperLogLog(self.precision)
+        new.registers = bytearray(self.registers)
+        new.harmonic = self.harmonic
+        new.zeros = self.zeros
+        return new
+
+    def estimate(self):
+        """Return the estimated number of distinct values."""
+        m = len(self.registers)
+        if m >= 128:
+            alpha = 0.7213 / (1 + 1.079 / m)
+        else:
+            alpha = {16: 0.673, 32: 0.697, 64: 0.709}[m]
+        estimate = alpha * m * m / self.harmonic
+        zeros = self.zeros
+        if zeros and estimate <= 2.5 * m:
+            estimate = m * math.log(float(m) / zeros)
+        return int(round(estimate))
+
+class QuantileSketch(object):
+    """Relative-error quantile estimates of a stream of numbers.
+
+    This is DDSketch: values are counted in logarithmic buckets so that any
+    quantile is estimated within a relative error of *accuracy*. If the
+    sketch grows beyond *size* buckets, the buckets holding the lowest
+    values are collapsed, which keeps memory bounded and only affects the
+    accuracy of the lowest quantiles. Sketches with the same accuracy can be
+    merged exactly with :meth:`merge`.
     """
+    __slots__ = ("accuracy", "gamma", "loggamma", "size", "positive",
+        "negative", "zeros", "count")
 
-    def __init__(self, level=logging.NOTSET, size=None, weight=1, reverse=True):
-        Collection.__init__(self, level=level, default=[])
+    def __init__(self, accuracy=0.01, size=2048):
+        if not 0 < accuracy < 1:
+            raise ValueError("accuracy must be between 0 and 1")
+        self.accuracy = accuracy
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.loggamma = math.log(self.gamma)
         self.size = size
-        self.weight = weight
-        self.reverse = reverse
+        self.positive = {}
+        self.negative = {}
+        self.zeros = 0
+        self.count = 0
 
-    def getvalue(self, record):
-        (value,) = Collection.getvalue(self, record)
-        weight = getattr(record, "weight", self.weight)
-        if callable(weight):
-            weight = weight(value)
-        return [(value, weight)]
+    def add(self, value, weight=1):
+        """Add *value* to the stream *weight* times."""
+        self.count += weight
+        if value > 0:
+            buckets = self.positive
+        elif value < 0:
+            buckets = self.negative
+            value = -value
+        else:
+            self.zeros += weight
+            return
+        key = int(math.ceil(math.log(value) / self.loggamma))
+        buckets[key] = buckets.get(key, 0) + weight
+        if len(self.positive) + len(self.negative) > self.size:
+            self.collapse()
 
-    def emitvalue(self, value, index):
-        Collection.emitvalue(self, value, index)
-        self.indices[index] = sorted(self.indices[index],
-                key=operator.itemgetter(1), 
-                reverse=self.reverse)[:self.size]
+    def collapse(self):
+        """Fold the lowest buckets together until the sketch fits *size*."""
+        excess = len(self.positive) + len(self.negative) - self.size
+        if excess <= 0:
+            return
+        # The lowest values are the largest negative keys, then the smallest
+        # positive keys.
+        negative = sorted(self.negative, reverse=True)
+        positive = sorted(self.positive)
+        if len(negative) > excess:
+            self.foldbuckets(self.negative, negative[:excess + 1])
+        else:
+            if negative:
+                self.zeros += sum(self.negative.values())
+                self.negative = {}
+                excess -= len(negative)
+            if excess > 0:
+                self.foldbuckets(self.positive, positive[:excess + 1])
 
-class Minimum(Maximum):
-    """Keep only the values with the lowest weight."""
+    def foldbuckets(self, buckets, keys):
+        """Move the counts of all *keys* into the last of them."""
+        buckets[keys[-1]] += sum(buckets.pop(key) for key in keys[:-1])
 
-    def __init__(self, level=logging.NOTSET, size=None, weight=1, reverse=False):
-        Maximum.__init__(self, level=level, size=size, weight=weight, reverse=reverse)
+    def merge(self, other):
+        """Add the counts of *other* to this sketch."""
+        if other.accuracy != self.accuracy:
+            raise ValueError("cannot merge sketches of different accuracy")
+        for buckets, others in ((self.positive, other.positive),
+                (self.negative, other.negative)):
+            for key, count in others.items():
+                buckets[key] = buckets.get(key, 0) + count
+        self.zeros += other.zeros
+        self.count += other.count
+        self.collapse()
 
-class Set(Collection):
-    """A collection of unique items.
+    def quantile(self, q):
+        """Return the estimated *q* quantile, or None if the sketch is empty."""
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for key in sorted(self.negative, reverse=True):
+            seen += self.negative[key]
+            if seen > rank:
+                return -self.bucketvalue(key)
+        seen += self.zeros
+        if seen > rank:
+            return 0
+        for key in sorted(self.positive):
+            seen += self.positive[key]
+            if seen > rank:
+                return self.bucketvalue(key)
+        return self.bucketvalue(max(self.positive))
 
-    If any index grows beyond *size* members, the entire index is removed.
+    def bucketvalue(self, key):
+        """Return the value that best represents the bucket *key*."""
+        return 2 * self.gamma ** key / (self.gamma + 1)
+
+    def dump(self):
+        """Return the sketch as a tuple of its parameters and buckets."""
+        return (self.accuracy, self.size, self.zeros, self.count,
+            self.positive, self.negative)
+
+    @classmethod
+    def load(cls, state):
+        """Return a sketch from the output of :meth:`dump`."""
+        accuracy, size, zeros, count, positive, negative = state
+        sketch = cls(accuracy, size)
+        sketch.zeros = zeros
+        sketch.count = count
+        sketch.positive = dict(positive)
+        sketch.negative = dict(negative)
+        return sketch
+
+    def __copy__(self):
+        new = QuantileSketch(self.accuracy, self.size)
+        new.positive = dict(self.positive)
+        new.negative = dict(self.negative)
+        new.zeros = self.zeros
+        new.count = self.count
+        return new
+
+class Reservoir(object):
+    """A uniform random sample of at most *size* values of a stream.
+
+    Values are sampled with Vitter's algorithm R, so each value seen so far
+    is kept with equal probability; *seen* counts them.
     """
 
-    def __init__(self, level=logging.NOTSET, default=set(), size=None, op=set.union):
-        Collection.__init__(self, level=level, default=default, op=op)
+    def __init__(self, size):
         self.size = size
+        self.items = []
+        self.seen = 0
 
-    def getvalue(self, record):
-        value = Collection.getvalue(self, record)
+    def add(self, value):
+        self.seen += 1
+        if len(self.items) < self.size:
+            self.items.append(value)
+            return
+        slot = random.randrange(self.seen)
+        if slot < self.size:
+            self.items[slot] = value
+
+    def merge(self, other):
+        """Sample from the union of this reservoir's stream and *other*'s.
+
+        Each kept value is drawn from one of the two reservoirs with
+        probability proportional to the number of values it has seen.
+        """
+        if not other.seen:
+            return
+        if not self.seen:
+            self.items = list(other.items)
+            self.seen = other.seen
+            return
+        mine, theirs = list(self.items), list(other.items)
+        random.shuffle(mine)
+        random.shuffle(theirs)
+        seen = self.seen + other.seen
+        items = []
+        left, right = self.seen, other.seen
+        while len(items) < self.size and (mine or theirs):
+            if theirs and (not mine or random.randrange(left + right) >= left):
+                items.append(theirs.pop())
+                right -= 1
+            else:
+                items.append(mine.pop())
+                left -= 1
+        self.items = items
+        self.seen = seen
+
+    def dump(self):
+        return [self.seen, list(self.items)]
+
+    @classmethod
+    def load(cls, value, size):
+        reservoir = cls(size)
+        reservoir.seen, reservoir.items = value[0], list(value[1])
+        return reservoir
+
+    def __copy__(self):
+        reservoir = Reservoir(self.size)
+        reservoir.items = list(self.items)
+        reservoir.seen = self.seen
+        return reservoir
+
+class NumericTable(MutableMapping):
+    """Numeric summaries of many indices stored in NumPy arrays.
+
+    Each index is given a dense row number (its slot) and its (count, sum,
+    minimum, maximum) summary lives in four column arrays, so a batch of
+    values can be added to many rows with a few vectorized calls (see
+    :meth:`add`). Reading or writing an index by key converts its row to or
+    from a tuple. Requires :mod:`numpy`.
+    """
+
+    def __init__(self, capacity=64):
+        self.slots = {}
+        self.keys = []
+        self.count = numpy.zeros(capacity, dtype=numpy.int64)
+        self.total = numpy.zeros(capacity)
+        self.minimum = numpy.zeros(capacity)
+        self.maximum = numpy.zeros(capacity)
+
+    def slot(self, index):
+        """Return the row of an index, allocating an empty one if needed."""
         try:
-            return set(value)
-        except TypeError:
-            return set(*value)
-    
-    def emitvalue(self, value, index):
-        Collection.emitvalue(self, value, index)
-        if self.size is not None and len(self.indices[index]) > self.size:
-            del(self.indices[index])
+            return self.slots[index]
+        except KeyError:
+            pass
+        slot = len(self.keys)
+        if slot == len(self.count):
+            for name in ("count", "total", "minimum", "maximum"):
+                column = getattr(self, name)
+                setattr(self, name, numpy.concatenate([column,
+                    numpy.zeros_like(column)]))
+        self.count[slot] = 0
+        self.total[slot] = 0
+        self.minimum[slot] = numpy.inf
+        self.maximum[slot] = -numpy.inf
+        self.slots[index] = slot
+        self.keys.append(index)
+        return slot
 
-class Top(StatzHandler):
-    pass
+    def add(self, slots, values):
+        """Add each of *values* to the row in the matching item of *slots*."""
+        slots = numpy.asarray(slots, dtype=numpy.intp)
+        values = numpy.asarray(values, dtype=numpy.float64)
+        numpy.add.at(self.count, slots, 1)
+        numpy.add.at(self.total, slots, values)
+        numpy.minimum.at(self.minimum, slots, values)
+        numpy.maximum.at(self.maximum, slots, values)
+
+    def __getitem__(self, index):
+        slot = self.slots[index]
+        return (int(self.count[slot]), float(self.total[slot]),
+            float(self.minimum[slot]), float(self.maximum[slot]))
+
+    def __setitem__(self, index, value):
+        slot = self.slot(index)
+        (self.count[slot], self.total[slot], self.minimum[slot],
+            self.maximum[slot]) = value
+
+    def __delitem__(self, index):
+        # Move the last row into the freed slot to keep the rows dense.
+        slot = self.slots.pop(index)
+        last = len(self.keys) - 1
+        moved = self.keys.pop()
+        if slot != last:
+            for column in (self.count, self.total, self.minimum, self.maximum):
+                column[slot] = column[last]
+            self.keys[slot] = moved
+            self.slots[moved] = slot
+
+    def __iter__(self):
+        return iter(list(self.keys))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, index):
+        return index in self.slots
+
+class MappedStorage(MutableMapping):
+    """Indices kept in files so that they survive restarts.
+
+    Index keys are recorded in an append-only log at *path* + ".keys": each
+    new index is given the next slot number, and deleted slots are never
+    reused. Subclasses store the values of each slot at *path*. Values
+    written to the page cache survive a crash of the process; call
+    :meth:`flush` to force them to disk.
+
+    Pass an instance as the *storage* parameter of a handler. Swapping out
+    the indices (see :meth:`StatzHandler.swapdata`) copies them to memory
+    with :meth:`detach` and empties the files.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.slots = {}
+        self.nextslot = 0
+        self.keyfd = os.open(path + ".keys",
+            os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self.readkeys()
+
+    def readkeys(self):
+        keys = {}
+        read = io.BytesIO(os.pread(self.keyfd,
+            os.fstat(self.keyfd).st_size, 0)).read
+        try:
+            while True:
+                marker = read(1)
+                if marker == b"R":
+                    keys[self.nextslot] = decode(read)
+                    self.nextslot += 1
+                elif marker == b"D":
+                    keys.pop(readvarint(read), None)
+                else:
+                    break
+        except (EOFError, ValueError):
+            # A record cut short by a crash; ignore it.
+            pass
+        self.slots = dict((index, slot) for slot, index in keys.items())
+
+    def allocate(self, index):
+        """Record a new index and return its slot."""
+        record = io.BytesIO()
+        record.write(b"R")
+        encode(index, record.write)
+        os.write(self.keyfd, record.getvalue())
+        slot = self.slots[index] = self.nextslot
+        self.nextslot += 1
+        return slot
+
+    def forget(self, index):
+        """Record the deletion of an index and return its slot."""
+        slot = self.slots.pop(index)
+        record = io.BytesIO()
+        record.write(b"D")
+        writevarint(record.write, slot)
+        os.write(self.keyfd, record.getvalue())
+        return slot
+
+    def detach(self):
+        """Return the indices as an in-memory dictionary and empty the files."""
+        data = dict((index, self.copyout(index)) for index in self.slots)
+        os.ftruncate(self.keyfd, 0)
+        self.slots = {}
+        self.nextslot = 0
+        self.truncate()
+        return data
+
+    def copyout(self, index):
+        return self[index]
+
+    def __iter__(self):
+        return iter(list(self.slots))
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __contains__(self, index):
+        return index in self.slots
+
+    def close(self):
+        os.close(self.keyfd)
+
+class MappedSlots(MappedStorage):
+    """Fixed-width numbers for each index in a memory-mapped file.
+
+    Each slot holds one number of the :mod:`array` *typecode* ("d" for
+    floats, "q" for 64 bit integers) and is read and written in place. This
+    suits :class:`Sum`. The file grows by doubling as slots are allocated.
+    """
+    header = 8
+
+    def __init__(self, path, typecode="d"):
+        self.typecode = typecode
+        self.width = struct.calcsize(typecode)
+        MappedStorage.__init__(self, path)
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        magic = b"SZLS" + struct.pack("B", FORMAT_VERSION) + typecode.encode()
+        existing = os.pread(self.fd, self.header, 0)
+        if existing and existing[:len(magic)] != magic:
+            raise ValueError("%s is not a %r slot file" % (path, typecode))
+        size = os.fstat(self.fd).st_size
+        self.mm = self.values = None
+        self.map(max(size, self.header + self.width * max(64, self.nextslot)))
+        self.mm[:len(magic)] = magic
+
+    def map(self, size):
+        if self.values is not None:
+            self.values.release()
+            self.mm.close()
+        os.ftruncate(self.fd, size)
+        self.mm = mmap.mmap(self.fd, size)
+        self.values = memoryview(self.mm)[self.header:].cast(self.typecode)
+
+    def __getitem__(self, index):
+        return self.values[self.slots[index]]
+
+    def __setitem__(self, index, value):
+        slot = self.slots.get(index)
+        if slot is None:
+            slot = self.allocate(index)
+        if slot >= len(self.values):
+            self.map(self.header + self.width * 2 * slot)
+        self.values[slot] = value
+
+    def __delitem__(self, index):
+        self.values[self.forget(index)] = 0
+
+    def truncate(self):
+        self.map(self.header)
+        self.map(self.header + self.width * 64)
+
+    def flush(self):
+        self.mm.flush()
+
+    def close(self):
+        self.values.release()
+        self.mm.close()
+        os.close(self.fd)
+        MappedStorage.close(self)
+
+class MappedList(object):
+    """A collection stored in a :class:`MappedLists` file."""
+    __slots__ = ("storage", "slot")
+
+    def __init__(self, storage, slot):
+        self.storage = storage
+        self.slot = slot
+
+    def extend(self, values):
+        self.storage.append(self.slot, values)
+
+    def update(self, values):
+        """Add the *values* the collection doesn't hold yet, as a set would."""
+        self.storage.appendnew(self.slot, values)
+
+    def __iter__(self):
+        read = self.storage.read
+        return (read(offset) for offset in self.storage.offsets[self.slot])
+
+    def __len__(self):
+        return len(self.storage.offsets[self.slot])
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __copy__(self):
+        return list(self)
+
+    def __repr__(self):
+        return repr(list(self))
+
+class MappedLists(MappedStorage):
+    """Collections of values in an append-only, memory-mapped file.
+
+    Each value is appended to the file as an encoded (slot, value) record
+    (see :func:`encode`); only the offsets of each index's values are kept
+    in memory, in an :class:`array.array`. Values are read back through a
+    memory map. Indices are :class:`MappedList` objects that grow in place,
+    which suits :class:`Collection` and :class:`Set`. The members of an
+    index a :class:`Set` updates are also kept in memory, so duplicates can
+    be skipped.
+    """
+
+    def __init__(self, path):
+        MappedStorage.__init__(self, path)
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self.size = os.fstat(self.fd).st_size
+        self.mm = None
+        self.offsets = dict((slot, array.array("q"))
+            for slot in self.slots.values())
+        self.members = {}
+        self.scan()
+
+    def scan(self):
+        """Rebuild the offsets of live slots from the file."""
+        if not self.size:
+            return
+        self.remap()
+        mm = self.mm
+        mm.seek(0)
+        try:
+            while mm.tell() < self.size:
+                slot = readvarint(mm.read)
+                offset = mm.tell()
+                decode(mm.read)
+                if slot in self.offsets:
+                    self.offsets[slot].append(offset)
+        except (EOFError, ValueError):
+            # A record cut short by a crash; drop it.
+            pass
+
+    def remap(self):
+        if self.mm is not None:
+            self.mm.close()
+        self.mm = mmap.mmap(self.fd, self.size, access=mmap.ACCESS_READ)
+
+    def append(self, slot, values):
+        """Append *values* to a slot's collection."""
+        record = io.BytesIO()
+        offsets = self.offsets[slot]
+        for value in values:
+            writevarint(record.write, slot)
+            offsets.append(self.size + record.tell())
+            encode(value, record.write)
+        os.write(self.fd, record.getvalue())
+        self.size += record.tell()
+
+    def appendnew(self, slot, values):
+        """Append the *values* a slot's collection doesn't hold yet."""
+        members = self.members.get(slot)
+        if members is None:
+            members = self.members[slot] = set(MappedList(self, slot))
+        new = []
+        for value in values:
+            if value not in members:
+                members.add(value)
+                new.append(value)
+        if new:
+            self.append(slot, new)
+
+    def read(self, offset):
+        """Return the value recorded at *offset*."""
+        if self.mm is None or offset >= len(self.mm):
+            self.remap()
+        self.mm.seek(offset)
+        return decode(self.mm.read)
+
+    def __getitem__(self, index):
+        return MappedList(self, self.slots[index])
+
+    def __setitem__(self, index, values):
+        if index in self.slots:
+            del self[index]
+        slot = self.allocate(index)
+        self.offsets[slot] = array.array("q")
+        self.append(slot, values)
+
+    def __delitem__(self, index):
+        slot = self.forget(index)
+        del self.offsets[slot]
+        self.members.pop(slot, None)
+
+    def copyout(self, index):
+        return list(self[index])
+
+    def truncate(self):
+        os.ftruncate(self.fd, 0)
+        self.size = 0
+        self.offsets = {}
+        self.members = {}
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+        os.close(self.fd)
+        MappedStorage.close(self)
+
+class IndexUsage(object):
+    """Track how a handler's indices are used to choose eviction victims.
+
+    The *policy* is one of:
+
+        * "lru" evict the least recently updated index
+        * "lfu" evict the least frequently updated index
+        * "weight" evict the lightest index (see
+          :meth:`StatzHandler.weighvalue`)
+
+    Frequencies and weights live in a heap that is refreshed lazily when
+    its root is examined, so :meth:`touch` costs O(1) or O(log n).
+    """
+
+    def __init__(self, policy="lru"):
+        if policy not in ("lru", "lfu", "weight"):
+            raise ValueError("policy must be 'lru', 'lfu' or 'weight'")
+        self.policy = policy
+        self.order = collections.OrderedDict()
+        self.heap = []
+        self.seq = 0
+
+    def touch(self, index, weigh):
+        """Note an update of *index*; *weigh* returns an index's weight."""
+        order = self.order
+        if self.policy == "lru":
+            if index in order:
+                order.move_to_end(index)
+            else:
+                order[index] = None
+        elif self.policy == "lfu":
+            hits = order.get(index, 0) + 1
+            order[index] = hits
+            if hits == 1:
+                self.push(1, index)
+        elif index not in order:
+            order[index] = True
+            self.push(weigh(index), index)
+
+    def push(self, key, index):
+        self.seq += 1
+        heapq.heappush(self.heap, (key, self.seq, index))
+
+    def discard(self, index):
+        """Forget *index*."""
+        self.order.pop(index, None)
+
+    def victim(self, keep, weigh):
+        """Forget and return the next index to evict, never *keep*.
+
+        Return None if there is no other index.
+        """
+        order = self.order
+        if self.policy == "lru":
+            for index in order:
+                if index != keep:
+                    del order[index]
+                    return index
+            return None
+        heap = self.heap
+        skipped = None
+        victim = None
+        while heap:
+            key, _, index = heap[0]
+            if index not in order:
+                heapq.heappop(heap)
+                continue
+            if self.policy == "lfu":
+                current = order[index]
+            else:
+                current = weigh(index)
+            if current != key:
+                self.seq += 1
+                heapq.heapreplace(heap, (current, self.seq, index))
+                continue
+            entry = heapq.heappop(heap)
+            if index == keep:
+                skipped = entry
+                continue
+            del order[index]
+            victim = index
+            break
+        if skipped is not None:
+            heapq.heappush(heap, skipped)
+        return victim
+
+class IndexOrder(object):
+    """A running total and an ordering of a handler's index weights.
+
+    Each index's latest weight (see :meth:`StatzHandler.weighvalue`) is
+    kept along with their sum and a heap of (-weight, sequence, index)
+    entries. Entries left behind by later updates are skipped when they
+    surface and the heap is rebuilt once they outnumber the live ones, so
+    :meth:`note` costs O(log n) and reading the *k* heaviest indices costs
+    O(k log n).
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.heap = []
+        self.total = 0
+        self.seq = 0
+
+    def note(self, index, weight):
+        """Record the current *weight* of *index*."""
+        entry = self.entries.get(index)
+        if entry is not None:
+            if entry[0] == weight:
+                return
+            self.total -= entry[0]
+        self.total += weight
+        self.seq += 1
+        self.entries[index] = (weight, self.seq)
+        heapq.heappush(self.heap, (-weight, self.seq, index))
+        if len(self.heap) > 2 * len(self.entries) + 64:
+            self.rebuild()
+
+    def discard(self, index):
+        """Forget *index*."""
+        entry = self.entries.pop(index, None)
+        if entry is not None:
+            self.total -= entry[0]
+
+    def rebuild(self):
+        """Drop stale heap entries and recompute the total."""
+        self.heap = [(-weight, seq, index)
+            for index, (weight, seq) in self.entries.items()]
+        heapq.heapify(self.heap)
+        self.total = sum(weight for weight, _ in self.entries.values())
+
+    def heaviest(self, n=None, where=None, minimum=None):
+        """Return up to *n* indices, heaviest first.
+
+        Only indices for which *where* returns true and whose weight is at
+        least *minimum* are returned, if those are given.
+        """
+        heap = self.heap
+        entries = self.entries
+        popped = []
+        indices = []
+        try:
+            while heap and (n is None or len(indices) < n):
+                entry = heap[0]
+                weight, seq, index = -entry[0], entry[1], entry[2]
+                current = entries.get(index)
+                if current is None or current[1] != seq:
+                    heapq.heappop(heap)
+                    continue
+                if minimum is not None and weight < minimum:
+                    break
+                popped.append(heapq.heappop(heap))
+                if where is None or where(index):
+                    indices.append(index)
+        finally:
+            for entry in popped:
+                heapq.heappush(heap, entry)
+        return indices
+
+class Sampler(logging.Filter):
+    """Pass a random sample of the records reaching a handler.
+
+    Each record passes with probability *rate*. If *target* is given, the
+    rate is adjusted every *interval* seconds (judged by the records'
+    *created* timestamps) so that about *target* records per second pass.
+    Rejected records never reach :meth:`StatzHandler.emit`; records that
+    pass get a *samplerate* attribute holding the rate they were sampled
+    at, which :class:`Sum` uses to scale their values.
+    """
+
+    def __init__(self, rate=1.0, target=None, interval=1.0):
+        logging.Filter.__init__(self)
+        if not 0 < rate <= 1:
+            raise ValueError("rate must be in (0, 1]")
+        self.rate = rate
+        self.target = target
+        self.interval = interval
+        self.started = None
+        self.offered = 0
+
+    def filter(self, record):
+        if self.target is not None:
+            self.adapt(record.created)
+        rate = self.rate
+        if rate < 1.0 and random.random() >= rate:
+            return False
+        record.samplerate = rate
+        return True
+
+    def adapt(self, now):
+        """Count an offered record and update *rate* once per interval."""
+        self.offered += 1
+        if self.started is None:
+            self.started = now
+        elapsed = now - self.started
+        if elapsed >= self.interval:
+            offered = self.offered / elapsed
+            self.rate = min(1.0, self.target / offered)
+            self.started = now
+            self.offered = 0
+
+class Instrumentation(object):
+    """Sampled measurements of a handler's own cost.
+
+    Every record passed to :meth:`StatzHandler.handle` is counted in
+    *handled*; one in every *sample* also has the time spent waiting for the
+    handler lock and the time spent handling it (with the lock held) added
+    up. *handled* is counted before the lock is taken, so threads handling
+    records at once may lose the odd increment.
+    """
+
+    def __init__(self, sample=100):
+        self.sample = sample
+        self.handled = 0
+        self.sampled = 0
+        self.lockwait = 0.0
+        self.emittime = 0.0
+
+    def add(self, lockwait, emittime):
+        self.sampled += 1
+        self.lockwait += lockwait
+        self.emittime += emittime
+
+def sizeof(obj, depth=3):
+    """Estimate the memory used by *obj* and the objects it holds."""
+    size = sys.getsizeof(obj)
+    if depth <= 0 or isinstance(obj, (str, bytes, int, float)):
+        return size
+    depth -= 1
+    if isinstance(obj, dict):
+        return size + sum(sizeof(key, depth) + sizeof(value, depth)
+            for key, value in obj.items())
+    if isinstance(obj, (list, tuple, set, frozenset, collections.deque)):
+        return size + sum(sizeof(item, depth) for item in obj)
+    if hasattr(obj, "__dict__"):
+        return size + sizeof(vars(obj), depth)
+    for name in getattr(type(obj), "__slots__", ()):
+        size += sizeof(getattr(obj, name, None), depth)
+    return size
+
+class StatzHandler(logging.Handler):
+    """A basic handler to receive statistics in the form of LogRecords.
+
+    The StatzHandler knows how to index and aggregate LogRecords. Various
+    subclasses may aggregate records differently, but they all maintain a
+    *indices* attribute. *indices* is a dictionary with keys accumulated during
+    a logging run; its values are the logged data aggregated by index.
+
+    These handlers rely on extra information supplied when a LogRecord is
+    created (see :meth:`getvalue`). Instantiation of a StatzHandler is no
+    different from that of a normal Handler, except for a few optional
+    parameters shared by every handler:
+
+        * *maxindices* maximum number of indices kept by the handler
+        * *eviction* how to pick the index evicted when there are too many:
+          "lru", "lfu" or "weight" (see :class:`IndexUsage`)
+        * *onevict* callable receiving the index and the public form of its
+          value when an index is evicted, for example to spill it to a sink
+        * *storage* a mapping used to hold the indices instead of a
+          dictionary, such as :class:`MappedSlots` or :class:`MappedLists`
+        * *dimensions* a sequence of record attribute names; if given, each
+          record is aggregated once under the tuple of those attributes
+          (see :meth:`getindices` and :meth:`rollup`)
+        * *rate* the probability that a record is aggregated, and *target*
+          a number of records per second to adapt the rate to (see
+          :class:`Sampler`, which is added to the handler's filters as
+          *sampler*)
+        * *ordered* whether to keep the weights of the indices ordered and
+          totalled as they are updated (see :class:`IndexOrder`), so that
+          :meth:`top`, :meth:`total` and :meth:`select` don't scan every
+          index
+
+    Evictions are counted in *evicted*. A handler can also measure its
+    own cost; see :meth:`instrument` and :meth:`metrics`.
+    """
+
+    def __init__(self, level=logging.NOTSET, maxindices=None, eviction="lru",
+            onevict=None, storage=None, dimensions=None, rate=None,
+            target=None, ordered=False):
+        logging.Handler.__init__(self, level=level)
+        self.sampler = None
+        if rate is not None or target is not None:
+            self.sampler = Sampler(1.0 if rate is None else rate, target)
+            self.addFilter(self.sampler)
+        if dimensions is not None:
+            dimensions = tuple(dimensions)
+        self.dimensions = dimensions
+        self.storage = storage
+        self.maxindices = maxindices
+        self.ordered = ordered
+        self.tracking = maxindices is not None or ordered
+        self.eviction = eviction
+        self.onevict = onevict
+        self.evicted = 0
+        self.instrumentation = None
+        self.data = None
+        self.shared = None
+        self.cleardata()
+
+    @property
+    def indices(self):
+        """A dictionary of indices.
+
+        :meth:`emit` stores new record values after determining the appropriate
+        index for a record (see :meth:`getindices`). Values are kept in
+        *data* in the handler's internal form and converted by
+        :meth:`readvalue` when they are read. The view is live; use
+        :meth:`snapshot` to read indices while other threads emit.
+
+        The view itself can't be changed. Assigning a mapping to *indices*
+        replaces every index: the old ones are dropped as by
+        :meth:`swapdata` and the new ones merged in with :meth:`mergedata`,
+        so they must be in the handler's internal form (for :class:`Sum`,
+        :class:`Collection` and :class:`Set`, the same as the public form).
+        To reset a handler and keep what it held, use
+        ``snapshot(reset=True)``.
+        """
+        return Indices(self.getdata(), self.readvalue)
+
+    @indices.setter
+    def indices(self, indices):
+        self.acquire()
+        try:
+            self.swapdata()
+            self.mergedata(indices)
+        finally:
+            self.release()
+
+    def getdata(self):
+        """Return a dictionary of indices in their internal form."""
+        return self.data
+
+    def newdata(self):
+        """Return an empty mapping to hold the handler's indices."""
+        return {}
+
+    def cleardata(self):
+        """Replace the indices with an empty mapping; return the old one.
+
+        Indices in *storage* are copied to a dictionary and the storage is
+        emptied instead.
+        """
+        if self.storage is None:
+            data, self.data = self.data, self.newdata()
+        elif self.data is None:
+            data = self.data = self.storage
+        else:
+            data = self.storage.detach()
+        self.shared = None
+        if self.maxindices is not None:
+            self.usage = IndexUsage(self.eviction)
+        if self.ordered:
+            self.order = IndexOrder()
+            for index, value in self.data.items():
+                self.order.note(index, self.weighvalue(value))
+        return data
+
+    def track(self, index):
+        """Note an update of *index* and evict indices beyond *maxindices*.
+
+        Handlers call this after updating an index if *tracking* is true,
+        which it is when *maxindices* or *ordered* is given.
+        """
+        data = self.data
+        if index not in data:
+            if self.maxindices is not None:
+                self.usage.discard(index)
+            if self.ordered:
+                self.order.discard(index)
+            return
+        if self.ordered:
+            self.order.note(index, self.weighvalue(data[index]))
+        if self.maxindices is None:
+            return
+        weigh = lambda index: self.weighvalue(data[index])
+        self.usage.touch(index, weigh)
+        while len(data) > self.maxindices:
+            victim = self.usage.victim(index, weigh)
+            if victim is None:
+                break
+            if victim not in data:
+                continue
+            value = data.pop(victim)
+            if self.ordered:
+                self.order.discard(victim)
+            self.evicted += 1
+            if self.onevict is not None:
+                self.onevict(victim, self.readvalue(value))
+
+    def top(self, n=10, where=None):
+        """Return the *n* heaviest indices as (index, value) pairs.
+
+        Indices are ordered by :meth:`weighvalue` (the value of a
+        :class:`Sum`, the size of a :class:`Collection` or :class:`Set`, and
+        so on), heaviest first. If *where* is given, only indices for which
+        it returns true are considered. An *ordered* handler answers in
+        O(n log m) for m indices; others scan every index.
+        """
+        self.acquire()
+        try:
+            data = self.getdata()
+            if self.ordered:
+                indices = self.order.heaviest(n, where)
+            else:
+                indices = heapq.nlargest(n,
+                    (index for index in data if where is None or where(index)),
+                    key=lambda index: self.weighvalue(data[index]))
+            return [(index, self.readvalue(self.copyvalue(data[index])))
+                for index in indices]
+        finally:
+            self.release()
+
+    def total(self):
+        """Return the sum of the weights (see :meth:`top`) of every index."""
+        self.acquire()
+        try:
+            if self.ordered:
+                return self.order.total
+            return sum(self.weighvalue(value)
+                for value in self.getdata().values())
+        finally:
+            self.release()
+
+    def select(self, where=None, minimum=None):
+        """Return a dictionary of the indices matching a filter.
+
+        Indices are kept if *where* returns true for them and if their
+        weight (see :meth:`top`) is at least *minimum*. On an *ordered*
+        handler, a *minimum* only visits the indices at least that heavy.
+        """
+        self.acquire()
+        try:
+            data = self.getdata()
+            if self.ordered and minimum is not None:
+                indices = self.order.heaviest(where=where, minimum=minimum)
+            else:
+                indices = [index for index, value in data.items()
+                    if (where is None or where(index)) and
+                    (minimum is None or self.weighvalue(value) >= minimum)]
+            return dict((index, self.readvalue(self.copyvalue(data[index])))
+                for index in indices)
+        finally:
+            self.release()
+
+    def instrument(self, sample=100):
+        """Measure the handler's own cost, sampling one in *sample* records.
+
+        Instrumentation replaces :meth:`handle` on this handler with a
+        version that counts records and, for sampled records, times the
+        wait for the handler lock and the work done while holding it. Pass
+        None to turn it off again; a handler that is not instrumented runs
+        the plain :meth:`handle` and pays nothing. See :meth:`metrics`.
+        """
+        self.__dict__.pop("handle", None)
+        self.instrumentation = None
+        if sample is None:
+            return
+        state = self.instrumentation = Instrumentation(sample)
+        handle = type(self).handle.__get__(self)
+        acquire, release = self.acquire, self.release
+        clock = time.perf_counter
+
+        def instrumented(record):
+            count = state.handled = state.handled + 1
+            if count % sample:
+                return handle(record)
+            began = clock()
+            acquire()
+            try:
+                acquired = clock()
+                rv = handle(record)
+                state.add(acquired - began, clock() - acquired)
+            finally:
+                release()
+            return rv
+
+        self.handle = instrumented
+
+    def metrics(self):
+        """Return a dictionary describing the handler's own cost.
+
+        The dictionary holds the number of *indices*, an estimate of the
+        *bytes* they use (extrapolated from a sample of at most 32 indices)
+        and the *evicted* and *dropped* counts. An instrumented handler
+        (see :meth:`instrument`) adds the number of records *handled*, how
+        many were *sampled* and their mean *lockwait* and *emittime* in
+        seconds.
+        """
+        self.acquire()
+        try:
+            data = self.getdata()
+            count = len(data)
+            sample = list(itertools.islice(data.items(), 32))
+            size = sum(sizeof(index) + sizeof(value) for index, value in sample)
+        finally:
+            self.release()
+        metrics = dict(
+            indices=count,
+            bytes=size * count // len(sample) if sample else 0,
+            evicted=self.evicted,
+            dropped=getattr(self, "dropped", 0),
+        )
+        state = self.instrumentation
+        if state is not None:
+            sampled = state.sampled
+            metrics.update(
+                handled=state.handled,
+                sampled=sampled,
+                lockwait=state.lockwait / sampled if sampled else 0.0,
+                emittime=state.emittime / sampled if sampled else 0.0,
+            )
+        return metrics
+
+    def snapshot(self, reset=False):
+        """Return a consistent, read-only view of the indices.
+
+        If *reset* is true, the indices are swapped for an empty mapping in
+        O(1) (see :meth:`swapdata`) and handed to the view. Otherwise the
+        view shares the handler's values until they are next written (see
+        :meth:`copydata`), and reads them with :meth:`readcopy`. Either way,
+        later records do not change the view, and changing what the view
+        returns does not change the handler.
+        """
+        if reset:
+            return Indices(self.swapdata(), self.readvalue)
+        return Indices(self.copydata(), self.readcopy)
+
+    def readcopy(self, value):
+        """Return the public form of *value* as an object safe to modify.
+
+        :meth:`readvalue` may return *value* itself (the list of a
+        :class:`Collection`, for example); it is copied first in that case.
+        """
+        public = self.readvalue(value)
+        if public is value:
+            public = self.readvalue(self.copyvalue(value))
+        return public
+
+    def copydata(self):
+        """Return a copy of the indices in their internal form.
+
+        The copy is taken copy-on-write: only the dictionary of indices is
+        copied while the handler lock is held, and its values are shared
+        with the handler until :meth:`unshare` copies an index on its first
+        write. The values must therefore be treated as read-only. Indices
+        in *storage* are copied eagerly instead.
+        """
+        self.acquire()
+        try:
+            data = self.getdata()
+            if self.storage is not None:
+                return dict((index, self.copyvalue(value))
+                    for index, value in data.items())
+            copied = dict(data.items())
+            self.shared = set(copied)
+            return copied
+        finally:
+            self.release()
+
+    def unshare(self, index):
+        """Copy *index* before it is written if a copy still shares it.
+
+        Handlers that change a value in place (rather than replacing it)
+        call this first when *shared*, the indices handed out by
+        :meth:`copydata` and not written since, is not empty. An index is
+        copied at most once per copy.
+        """
+        shared = self.shared
+        if index in shared:
+            shared.discard(index)
+            data = self.data
+            if index in data:
+                data[index] = self.copyvalue(data[index])
+
+    def dump(self, fileobj, reset=False):
+        """Write the indices to *fileobj* as a binary stream.
+
+        The stream is written with :func:`dumpstream` and can be merged
+        into a handler of the same kind with :meth:`load`. If *reset* is
+        true, the indices are swapped out as in :meth:`snapshot`.
+        """
+        if reset:
+            data = self.swapdata()
+        else:
+            data = self.copydata()
+        self.dumpdata(fileobj, data)
+
+    def dumpdata(self, fileobj, data):
+        """Write a dictionary of indices in internal form to *fileobj*."""
+        dumpstream(fileobj, self.getkind(), ((index, self.dumpvalue(value))
+            for index, value in data.items()))
+
+    def load(self, fileobj):
+        """Merge a stream written by :meth:`dump` into the indices.
+
+        Records are decoded and merged one at a time.
+        """
+        kind, records = readstream(fileobj)
+        if kind != self.getkind():
+            raise ValueError("cannot load %s indices into %s" %
+                (kind, self.getkind()))
+        for index, value in records:
+            self.mergedata({index: self.loadvalue(value)})
+
+    def getkind(self):
+        """Return the name recorded in streams written by this handler."""
+        return self.__class__.__name__
+
+    def swapdata(self):
+        """Replace the handler's indices with an empty dictionary.
+
+        Return the previous indices in their internal form.
+        """
+        self.acquire()
+        try:
+            data = self.cleardata()
+        finally:
+            self.release()
+        return data
+
+    def merge(self, other):
+        """Fold the indices of another handler of the same kind into this one."""
+        other.acquire()
+        try:
+            self.mergedata(other.getdata())
+        finally:
+            other.release()
+
+    def mergedata(self, data):
+        """Fold a dictionary of indices in their internal form into this one.
+
+        *data* typically comes from :meth:`swapdata` or :meth:`getdata` on a
+        handler of the same kind; it is not modified.
+        """
+        self.acquire()
+        try:
+            for index, value in data.items():
+                if self.shared:
+                    self.unshare(index)
+                if index in self.data:
+                    self.data[index] = self.mergevalue(self.data[index], value)
+                else:
+                    self.data[index] = self.copyvalue(value)
+                if self.tracking:
+                    self.track(index)
+        finally:
+            self.release()
+
+    def clone(self):
+        """Return a new, empty handler configured like this one."""
+        clone = copy.copy(self)
+        clone.filters = list(self.filters)
+        clone.storage = clone.data = None
+        clone.cleardata()
+        clone.createLock()
+        if self.instrumentation is not None:
+            clone.instrument(self.instrumentation.sample)
+        return clone
+
+    def close(self):
+        """Close the handler and its *storage*, if any."""
+        if self.storage is not None:
+            self.storage.close()
+            self.storage = None
+        logging.Handler.close(self)
+
+    def getindices(self, record):
+        """Return a list of indices for a given record.
+
+        The list of indices will either contain the record's *index* attribute
+        or a list generated from its iterable *indices* attribute. If both
+        attributes are present, *index* will be added to *indices*. If no
+        indices are defined, the resulting list will be [None].
+
+        If the handler has *dimensions*, the list instead holds a single
+        tuple of the record's attributes named by *dimensions*, with None
+        for missing attributes.
+        """
+        if self.dimensions is not None:
+            return [tuple(getattr(record, name, None)
+                for name in self.dimensions)]
+        index = getattr(record, "index", None)
+        indices = list(getattr(record, "indices", []))
+        if index is not None:
+            indices.append(index)
+        if not indices:
+            indices = [None]
+
+        return indices
+
+    def rollup(self, by=(), where=None):
+        """Return the indices merged over the dimensions not in *by*.
+
+        The handler must have *dimensions*. Each key of the result is the
+        tuple of an index's values for the dimensions named in *by*; the
+        values of every index sharing that key are combined with
+        :meth:`mergevalue`. *where* optionally maps dimension names to a
+        value an index must have, or to a predicate it must satisfy. For
+        example, with *dimensions* ("method", "path", "status")::
+
+            >>> handler.rollup(by=["path"],
+            ...     where={"status": lambda status: status >= 500})
+            {("/api",): 12, ("/static",): 1}
+        """
+        if self.dimensions is None:
+            raise ValueError("rollup needs a handler with dimensions")
+        positions = dict((name, i) for i, name in enumerate(self.dimensions))
+        try:
+            by = [positions[name] for name in by]
+            tests = [(positions[name], test)
+                for name, test in (where or {}).items()]
+        except KeyError as e:
+            raise ValueError("unknown dimension %r" % e.args[0])
+        tests = [(position, test if callable(test) else
+            functools.partial(operator.eq, test)) for position, test in tests]
+
+        merged = {}
+        self.acquire()
+        try:
+            for index, value in self.getdata().items():
+                if not all(test(index[position]) for position, test in tests):
+                    continue
+                key = tuple(index[position] for position in by)
+                if key in merged:
+                    merged[key] = self.mergevalue(merged[key], value)
+                else:
+                    merged[key] = self.copyvalue(value)
+        finally:
+            self.release()
+        return dict((key, self.readvalue(value))
+            for key, value in merged.items())
+
+    def getvalue(self, record):
+        """Return the value of a LogRecord instance.
+
+        If *record* has a *value* attribute, use that. Otherwise, use its *msg*
+        attribute. Note: LogRecords can be given (nearly) arbitrary attributes
+        at creation time by passing the *extra* keyword argument to the logging
+        method. For example::
+
+            >>> logging.debug("a message", extra={"value": "the real value"})
+
+        Subclasses override this to prepare a record's value for
+        :meth:`emitvalue` (for example, to work out its weight). It is
+        called once per record, and the result is shared by all of the
+        record's indices, so :meth:`emitvalue` must not modify it.
+        """
+        return getattr(record, "value", record.msg)
+
+    def emit(self, record):
+        """Emit the record.
+
+        Typically, this means aggregating it in one of the handler's indices
+        (under :attr:`indices`). The record's value is prepared once with
+        :meth:`getvalue` and then applied to each of its indices with
+        :meth:`emitvalue`.
+        """
+        value = self.getvalue(record)
+        for index in self.getindices(record):
+            self.emitvalue(value, index)
+            if self.tracking:
+                self.track(index)
+
+    def emitvalue(self, value, index):
+        """Emit a value for a single index."""
+        self.data[index] = value
+
+    def counter(self, index=None):
+        """Return a function that adds a value (1 by default) to *index*.
+
+        The function skips the logging machinery (records, filters, levels
+        and :meth:`getindices`) and feeds the same indices as :meth:`emit`,
+        under the handler lock. It is meant for hot counters::
+
+            >>> hits = handler.counter("hits")
+            >>> hits()
+            >>> hits(5)
+        """
+        lock = self.lock
+        emitvalue = self.emitvalue
+
+        def add(value=1):
+            lock.acquire()
+            try:
+                emitvalue(value, index)
+                if self.tracking:
+                    self.track(index)
+            finally:
+                lock.release()
+
+        return add
+
+    def emitmany(self, values, index=None, indices=()):
+        """Aggregate many values under one acquisition of the handler lock.
+
+        Each item of *values* is treated like the value of a record (see
+        :meth:`getvalue`), and the batch is added to *index* and every
+        member of *indices* (or to None if neither is given). Handlers
+        aggregate the batch with :meth:`emitvalues`.
+        """
+        values = list(values)
+        indices = list(indices)
+        if index is not None:
+            indices.append(index)
+        if not indices:
+            indices = [None]
+        if not values:
+            return
+        self.acquire()
+        try:
+            for index in indices:
+                self.emitvalues(values, index)
+                if self.tracking:
+                    self.track(index)
+        finally:
+            self.release()
+
+    def emitvalues(self, values, index):
+        """Aggregate a list of record values into a single index.
+
+        The base implementation emits each value in turn; subclasses fold
+        the whole list at once where they can.
+        """
+        for value in values:
+            self.emitvalue(value, index)
+
+    def emitcolumns(self, indices, values):
+        """Aggregate parallel sequences of indices and values.
+
+        Each item of *values* is added to the index in the matching item of
+        *indices*, under one acquisition of the handler lock. The values
+        are grouped by index and passed to :meth:`emitvalues`.
+        """
+        groups = {}
+        for index, value in zip(indices, values):
+            try:
+                groups[index].append(value)
+            except KeyError:
+                groups[index] = [value]
+        self.acquire()
+        try:
+            for index, group in groups.items():
+                self.emitvalues(group, index)
+                if self.tracking:
+                    self.track(index)
+        finally:
+            self.release()
+
+    def emitrecords(self, records):
+        """Filter and emit many records under one acquisition of the lock."""
+        self.acquire()
+        try:
+            for record in records:
+                if self.filter(record):
+                    self.emit(record)
+        finally:
+            self.release()
+
+    def readvalue(self, value):
+        """Return the public form of an index's aggregated *value*."""
+        return value
+
+    def mergevalue(self, value, other):
+        """Return the combination of two aggregated values for an index.
+
+        Values are in the handler's internal form. *value* may be modified
+        and returned; *other* is left alone. The base handler keeps only
+        the latest value, so it returns *other*.
+        """
+        return other
+
+    def copyvalue(self, value):
+        """Return a copy of an aggregated value that is safe to modify."""
+        return copy.copy(value)
+
+    def dumpvalue(self, value):
+        """Return an aggregated value in a form :func:`encode` supports."""
+        return value
+
+    def loadvalue(self, value):
+        """Return an aggregated value from the output of :meth:`dumpvalue`."""
+        return value
+
+    def weighvalue(self, value):
+        """Return the weight of an aggregated value for eviction.
+
+        Lighter indices are evicted first by the "weight" policy. The base
+        handler weighs numbers by their value and everything else as 0.
+        """
+        if isinstance(value, (int, float)):
+            return value
+        return 0
+
+class Sum(StatzHandler):
+    """The arithmetic sum of the value of each record.
+
+    Doesn't make sense for eg string values, but the implementation won't
+    complain. If the handler samples records (see *rate*), each value is
+    divided by the sampling rate so that the sums are unbiased estimates of
+    the totals. Parameters:
+
+        * *default* starting value
+        * *op* operator to add values together
+    """
+
+    def __init__(self, level=logging.NOTSET, default=0, op=operator.add,
+            **kwargs):
+        StatzHandler.__init__(self, level=level, **kwargs)
+        self.default = default
+        self.op = op
+
+    def getvalue(self, record):
+        value = StatzHandler.getvalue(self, record)
+        if self.sampler is not None:
+            rate = getattr(record, "samplerate", 1.0)
+            if rate < 1.0:
+                value = value / rate
+        return value
+
+    def emitvalue(self, value, index):
+        value = self.op(self.data.setdefault(index, self.default), value)
+        StatzHandler.emitvalue(self, value, index)
+
+    def emitvalues(self, values, index):
+        start = self.data.get(index, self.default)
+        if self.op is operator.add and isinstance(start, (int, float)):
+            self.data[index] = sum(values, start)
+        else:
+            self.data[index] = functools.reduce(self.op, values, start)
+
+    def emitcolumns(self, indices, values):
+        """Aggregate parallel sequences of indices and values.
+
+        If *values* is a :mod:`numpy` array of numbers added with the
+        default *op*, each index's values are totalled with
+        :func:`numpy.add.at` before being added to the index; an array of
+        *indices* is grouped with :func:`numpy.unique`. Otherwise (turning
+        a list into an array costs more than the vectorized sum saves) the
+        values are grouped by index and passed to :meth:`emitvalues`.
+        """
+        if (numpy is None or not isinstance(values, numpy.ndarray) or
+                values.ndim != 1 or values.dtype.kind not in "iuf" or
+                self.op is not operator.add or
+                type(self).emitvalues is not Sum.emitvalues):
+            return StatzHandler.emitcolumns(self, indices, values)
+        # Total in 64 bits, whatever the width of the values.
+        values = values.astype(dict(f=numpy.float64, i=numpy.int64,
+            u=numpy.uint64)[values.dtype.kind], copy=False)
+        if values.dtype.kind != "f" and len(values) and len(values) * max(
+                abs(int(values.min())), abs(int(values.max()))) >= 2 ** 63:
+            # The totals might overflow a 64-bit integer; add Python ints.
+            return StatzHandler.emitcolumns(self, indices, values.tolist())
+        if (isinstance(indices, numpy.ndarray) and indices.ndim == 1 and
+                indices.dtype.kind in "biufUS"):
+            keys, codes = numpy.unique(indices, return_inverse=True)
+            keys = keys.tolist()
+        else:
+            indices = list(indices)
+            slots = {}
+            codes = [slots.setdefault(index, len(slots)) for index in indices]
+            keys = list(slots)
+        if len(codes) != len(values):
+            return StatzHandler.emitcolumns(self, indices, values.tolist())
+        totals = numpy.zeros(len(keys), dtype=values.dtype)
+        numpy.add.at(totals, codes, values)
+        self.acquire()
+        try:
+            data = self.data
+            default = self.default
+            for index, total in zip(keys, totals.tolist()):
+                data[index] = data.get(index, default) + total
+                if self.tracking:
+                    self.track(index)
+        finally:
+            self.release()
+
+    def counter(self, index=None):
+        """Return a function that adds a value (1 by default) to *index*.
+
+        Plain sums without *maxindices* get a function that adds straight
+        into :attr:`data`, looked up on each call so that
+        :meth:`snapshot` resets are respected.
+        """
+        if (type(self).emitvalue is not Sum.emitvalue or
+                self.op is not operator.add or self.tracking):
+            return StatzHandler.counter(self, index)
+        lock = self.lock
+        default = self.default
+        handler = self
+
+        def add(value=1):
+            lock.acquire()
+            try:
+                data = handler.data
+                data[index] = data.get(index, default) + value
+            finally:
+                lock.release()
+
+        return add
+
+    def mergevalue(self, value, other):
+        return self.op(value, other)
+
+class Collection(Sum):
+    """A collection of records values.
+
+    By default, each index is a container that grows in place as records
+    arrive, so adding a value costs amortized O(1). If *op* is given, it is
+    used instead to combine the index with each new value (as in
+    :class:`Sum`).
+    """
+
+    def __init__(self, level=logging.NOTSET, default=None, op=None, **kwargs):
+        if default is None:
+            default = []
+        Sum.__init__(self, level=level, default=default, op=op or operator.add,
+            **kwargs)
+        self.inplace = op is None
+
+    def getvalue(self, record):
+        return self.preparevalue(StatzHandler.getvalue(self, record))
+
+    def preparevalue(self, value):
+        """Return a record's value in the form :meth:`emitvalue` takes.
+
+        :meth:`getvalue` and :meth:`emitvalues` both prepare values with
+        this, so that a batch is aggregated like the same values logged
+        one record at a time.
+        """
+        return [value]
+
+    def newvalue(self):
+        """Return a new container for an index, filled from *default*."""
+        return list(self.default)
+
+    def extendvalue(self, container, value):
+        """Add *value* to an index's *container* in place."""
+        container.extend(value)
+
+    def emitvalue(self, value, index):
+        if not self.inplace:
+            return Sum.emitvalue(self, value, index)
+        if self.shared:
+            self.unshare(index)
+        try:
+            container = self.data[index]
+        except KeyError:
+            self.data[index] = self.newvalue()
+            container = self.data[index]
+        self.extendvalue(container, value)
+
+    def emitvalues(self, values, index):
+        if not self.inplace:
+            return StatzHandler.emitvalues(self,
+                [self.preparevalue(value) for value in values], index)
+        if type(self).preparevalue is not Collection.preparevalue:
+            values = [item for value in values
+                for item in self.preparevalue(value)]
+        self.emitvalue(values, index)
+
+    def mergevalue(self, value, other):
+        if not self.inplace:
+            return Sum.mergevalue(self, value, other)
+        self.extendvalue(value, other)
+        return value
+
+    def readvalue(self, value):
+        if isinstance(value, MappedList):
+            return list(value)
+        return value
+
+    def dumpvalue(self, value):
+        return self.readvalue(value)
+
+    def weighvalue(self, value):
+        return len(value)
+
+class Maximum(Collection):
+    """Keep only the values with the highest weight.
+
+    In addition to the usual *msg* or *value* attributes, a LogRecord may set a
+    *weight* attribute to influence the record's place in the sorted collection.
+    Parameters:
+
+        * *size* maximum size of each index
+        * *weight* default record weight
+        * *reverse* direction in which to sort the collection
+
+    Each index is kept in a compact :class:`BoundedArray`, replaced by a
+    :class:`BoundedHeap` once a weight that isn't a float arrives, so a
+    record costs amortized O(log *size*); the sorted list is only built
+    when the index is read.
+    """
+
+    def __init__(self, level=logging.NOTSET, size=None, weight=1, reverse=True,
+            **kwargs):
+        Collection.__init__(self, level=level, default=[], **kwargs)
+        self.size = size
+        self.weight = weight
+        self.reverse = reverse
+
+    def getvalue(self, record):
+        (value,) = Collection.getvalue(self, record)
+        weight = getattr(record, "weight", self.weight)
+        if callable(weight):
+            weight = weight(value)
+        return [(value, weight)]
+
+    def emitvalue(self, value, index):
+        if self.shared:
+            self.unshare(index)
+        heap = self.data.get(index)
+        if heap is None:
+            heap = self.data[index] = BoundedArray(self.size, self.reverse)
+        for item, weight in value:
+            try:
+                heap.push(item, weight)
+            except TypeError:
+                if not isinstance(heap, BoundedArray):
+                    raise
+                heap = self.data[index] = heap.widen()
+                heap.push(item, weight)
+
+    def emitvalues(self, values, index):
+        weight = self.weight
+        if callable(weight):
+            pairs = [(value, weight(value)) for value in values]
+        else:
+            pairs = [(value, weight) for value in values]
+        if numpy is not None and self.size and len(pairs) > 4 * self.size:
+            pairs = self.candidates(pairs)
+        if self.shared:
+            self.unshare(index)
+        if isinstance(self.data.get(index), BoundedHeap):
+            self.data[index].extend(pairs)
+        else:
+            self.emitvalue(pairs, index)
+
+    def candidates(self, pairs):
+        """Return the pairs of a batch that could make it into an index.
+
+        Only pairs at least as heavy as the *size*-th heaviest of the batch
+        (found with :func:`numpy.partition`) are kept, ties included, in
+        their original order. Non-numeric weights are returned unchanged.
+        """
+        try:
+            weights = numpy.fromiter((weight for _, weight in pairs),
+                dtype=numpy.float64, count=len(pairs))
+        except (TypeError, ValueError):
+            return pairs
+        if self.reverse:
+            threshold = numpy.partition(weights, -self.size)[-self.size]
+            keep = numpy.flatnonzero(weights >= threshold)
+        else:
+            threshold = numpy.partition(weights, self.size - 1)[self.size - 1]
+            keep = numpy.flatnonzero(weights <= threshold)
+        return [pairs[i] for i in keep]
+
+    def readvalue(self, value):
+        return value.items()
+
+    def mergevalue(self, value, other):
+        try:
+            value.merge(other)
+        except TypeError:
+            if not isinstance(value, BoundedArray):
+                raise
+            value = value.widen()
+            value.merge(other)
+        return value
+
+    def dumpvalue(self, value):
+        return value.dump()
+
+    def loadvalue(self, value):
+        try:
+            return BoundedArray.load(value, self.size, self.reverse)
+        except TypeError:
+            return BoundedHeap.load(value, self.size, self.reverse)
+
+class Minimum(Maximum):
+    """Keep only the values with the lowest weight."""
+
+    def __init__(self, level=logging.NOTSET, size=None, weight=1, reverse=False,
+            **kwargs):
+        Maximum.__init__(self, level=level, size=size, weight=weight, reverse=reverse,
+            **kwargs)
+
+class Set(Collection):
+    """A collection of unique items.
+
+    If any index grows beyond *size* members, the entire index is removed.
+    """
+
+    def __init__(self, level=logging.NOTSET, default=None, size=None, op=None,
+            **kwargs):
+        if default is None:
+            default = set()
+        Collection.__init__(self, level=level, default=default, op=op, **kwargs)
+        if op is None:
+            self.op = set.union
+        self.size = size
+
+    def preparevalue(self, value):
+        try:
+            return set([value])
+        except TypeError:
+            return set(value)
+
+    def newvalue(self):
+        return set(self.default)
+
+    def extendvalue(self, container, value):
+        container.update(value)
+
+    def emitvalue(self, value, index):
+        Collection.emitvalue(self, value, index)
+        if self.size is not None and len(self.data[index]) > self.size:
+            del(self.data[index])
+
+    def mergedata(self, data):
+        """Fold a dictionary of indices into this one.
+
+        As with records, any index that grows beyond *size* members is
+        removed.
+        """
+        self.acquire()
+        try:
+            Collection.mergedata(self, data)
+            if self.size is None:
+                return
+            for index in data:
+                if len(self.data.get(index, ())) > self.size:
+                    del(self.data[index])
+                    if self.tracking:
+                        self.track(index)
+        finally:
+            self.release()
+
+    def readvalue(self, value):
+        if isinstance(value, (MappedList, list)):
+            return set(value)
+        return value
+
+    def copyvalue(self, value):
+        if isinstance(value, MappedList):
+            return set(value)
+        return Collection.copyvalue(self, value)
+
+class Sample(StatzHandler):
+    """A uniform random sample of at most *size* values per index.
+
+    Unlike a :class:`Set` or :class:`Maximum` with a *size*, which keep
+    the first or heaviest values, each index is a :class:`Reservoir` in
+    which every value logged so far is equally likely to be kept. Reading an
+    index returns the sampled values as a list.
+    """
+
+    def __init__(self, level=logging.NOTSET, size=100, **kwargs):
+        StatzHandler.__init__(self, level=level, **kwargs)
+        self.size = size
+
+    def emitvalue(self, value, index):
+        if self.shared:
+            self.unshare(index)
+        reservoir = self.data.get(index)
+        if reservoir is None:
+            reservoir = self.data[index] = Reservoir(self.size)
+        reservoir.add(value)
+
+    def emitvalues(self, values, index):
+        if self.shared:
+            self.unshare(index)
+        reservoir = self.data.get(index)
+        if reservoir is None:
+            reservoir = self.data[index] = Reservoir(self.size)
+        for value in values:
+            reservoir.add(value)
+
+    def readvalue(self, value):
+        return list(value.items)
+
+    def mergevalue(self, value, other):
+        value.merge(other)
+        return value
+
+    def dumpvalue(self, value):
+        return value.dump()
+
+    def loadvalue(self, value):
+        return Reservoir.load(value, self.size)
+
+    def weighvalue(self, value):
+        return value.seen
+
+class Top(StatzHandler):
+    """The most frequent values of each index.
+
+    Each index is a :class:`StreamSummary` that counts at most *size* values,
+    so memory does not depend on how many distinct values are logged.
+    Instead of *size*, an *error* fraction may be given: counts are then
+    overestimated by at most *error* times the total weight of the index.
+    A record's *weight* attribute (or the *weight* parameter, which may be
+    callable) is added to its value's count. Parameters:
+
+        * *size* number of values counted per index
+        * *error* maximum relative error, used if *size* is not given
+        * *weight* default record weight
+
+    Reading an index returns (value, count) pairs, most frequent first.
+    """
+
+    def __init__(self, level=logging.NOTSET, size=None, error=None, weight=1,
+            **kwargs):
+        StatzHandler.__init__(self, level=level, **kwargs)
+        if size is None:
+            size = 10 if error is None else int(math.ceil(1.0 / error))
+        self.size = size
+        self.weight = weight
+
+    def getvalue(self, record):
+        value = StatzHandler.getvalue(self, record)
+        weight = getattr(record, "weight", self.weight)
+        if callable(weight):
+            weight = weight(value)
+        return [(value, weight)]
+
+    def emitvalue(self, value, index):
+        if self.shared:
+            self.unshare(index)
+        summary = self.data.get(index)
+        if summary is None:
+            summary = self.data[index] = StreamSummary(self.size)
+        for item, weight in value:
+            summary.add(item, weight)
+
+    def emitvalues(self, values, index):
+        weight = self.weight
+        if callable(weight):
+            pairs = [(value, weight(value)) for value in values]
+        else:
+            pairs = [(value, count * weight) for value, count
+                in collections.Counter(values).items()]
+        self.emitvalue(pairs, index)
+
+    def readvalue(self, value):
+        return value.items()
+
+    def mergevalue(self, value, other):
+        value.merge(other)
+        return value
+
+    def weighvalue(self, value):
+        return value.total
+
+    def dumpvalue(self, value):
+        return value.dump()
+
+    def loadvalue(self, value):
+        return StreamSummary.load(value)
+
+    def bounds(self, index):
+        """Return (value, lower, upper) bounds on the counts of an index."""
+        return self.data[index].bounds()
+
+
+class Unique(StatzHandler):
+    """An estimate of the number of unique values in each index.
+
+    Unlike :class:`Set`, memory per index is fixed: each index is a
+    :class:`HyperLogLog` estimator with 2 ** *precision* one-byte registers
+    and a standard error of about 1.04 / sqrt(2 ** *precision*). Reading an
+    index returns the estimated count. Parameters:
+
+        * *precision* number of register bits, between 4 and 16
+    """
+
+    def __init__(self, level=logging.NOTSET, precision=12, **kwargs):
+        StatzHandler.__init__(self, level=level, **kwargs)
+        self.precision = precision
+
+    def emitvalue(self, value, index):
+        if self.shared:
+            self.unshare(index)
+        estimator = self.data.get(index)
+        if estimator is None:
+            estimator = self.data[index] = HyperLogLog(self.precision)
+        estimator.add(value)
+
+    def emitvalues(self, values, index):
+        if self.shared:
+            self.unshare(index)
+        estimator = self.data.get(index)
+        if estimator is None:
+            estimator = self.data[index] = HyperLogLog(self.precision)
+        try:
+            values = set(values)
+        except TypeError:
+            pass
+        for value in values:
+            estimator.add(value)
+
+    def readvalue(self, value):
+        return value.estimate()
+
+    def weighvalue(self, value):
+        return value.estimate()
+
+    def dumpvalue(self, value):
+        return value.dump()
+
+    def loadvalue(self, value):
+        return HyperLogLog.load(value)
+
+    def mergevalue(self, value, other):
+        value.merge(other)
+        return value
+
+class Quantile(StatzHandler):
+    """Approximate quantiles of the numeric values of each index.
+
+    Each index is a :class:`QuantileSketch`, so memory is bounded by *size*
+    buckets and every estimate is within a relative error of *accuracy*.
+    Reading an index returns a dictionary mapping each of *quantiles* to
+    its estimate; :meth:`quantile` estimates any other quantile. Parameters:
+
+        * *quantiles* quantiles reported for each index
+        * *accuracy* relative error of the estimates
+        * *size* maximum number of buckets per index
+    """
+
+    def __init__(self, level=logging.NOTSET, quantiles=(0.5, 0.95, 0.99),
+            accuracy=0.01, size=2048, **kwargs):
+        StatzHandler.__init__(self, level=level, **kwargs)
+        self.quantiles = quantiles
+        self.accuracy = accuracy
+        self.size = size
+
+    def emitvalue(self, value, index):
+        if self.shared:
+            self.unshare(index)
+        sketch = self.data.get(index)
+        if sketch is None:
+            sketch = self.data[index] = QuantileSketch(self.accuracy, self.size)
+        sketch.add(value)
+
+    def emitvalues(self, values, index):
+        if self.shared:
+            self.unshare(index)
+        sketch = self.data.get(index)
+        if sketch is None:
+            sketch = self.data[index] = QuantileSketch(self.accuracy, self.size)
+        for value, count in collections.Counter(values).items():
+            sketch.add(value, count)
+
+    def readvalue(self, value):
+        return dict((q, value.quantile(q)) for q in self.quantiles)
+
+    def mergevalue(self, value, other):
+        value.merge(other)
+        return value
+
+    def weighvalue(self, value):
+        return value.count
+
+    def dumpvalue(self, value):
+        return value.dump()
+
+    def loadvalue(self, value):
+        return QuantileSketch.load(value)
+
+    def quantile(self, index, q):
+        """Return the estimated *q* quantile of an index."""
+        return self.data[index].quantile(q)
+
+class Summary(StatzHandler):
+    """The count, sum, mean, minimum and maximum of each index.
+
+    Values must be numbers. Each index is kept as a (count, sum, minimum,
+    maximum) tuple; reading it returns a dictionary with the keys "count",
+    "sum", "mean", "min" and "max". If :mod:`numpy` is installed, indices
+    live in a :class:`NumericTable` and :meth:`~StatzHandler.emitcolumns`
+    adds a whole batch of (index, value) pairs with a few vectorized calls.
+    Without numpy, the same interface is served by plain dictionaries.
+    """
+
+    def newdata(self):
+        if numpy is None:
+            return {}
+        return NumericTable()
+
+    def emitvalue(self, value, index):
+        state = self.data.get(index)
+        if state is None:
+            self.data[index] = (1, value, value, value)
+        else:
+            count, total, minimum, maximum = state
+            self.data[index] = (count + 1, total + value,
+                min(minimum, value), max(maximum, value))
+
+    def emitvalues(self, values, index):
+        state = (len(values), sum(values), min(values), max(values))
+        if index in self.data:
+            state = self.mergevalue(self.data[index], state)
+        self.data[index] = state
+
+    def emitcolumns(self, indices, values):
+        if not isinstance(self.data, NumericTable):
+            return StatzHandler.emitcolumns(self, indices, values)
+        self.acquire()
+        try:
+            slot = self.data.slot
+            self.data.add([slot(index) for index in indices], values)
+            if self.tracking:
+                for index in set(indices):
+                    self.track(index)
+        finally:
+            self.release()
+
+    def readvalue(self, value):
+        count, total, minimum, maximum = value
+        return dict(count=count, sum=total, mean=float(total) / count,
+            min=minimum, max=maximum)
+
+    def mergevalue(self, value, other):
+        return (value[0] + other[0], value[1] + other[1],
+            min(value[2], other[2]), max(value[3], other[3]))
+
+    def weighvalue(self, value):
+        return value[0]
+
+    def loadvalue(self, value):
+        return tuple(value)
+
+class Wrapper(StatzHandler):
+    """A handler that passes records on to another *handler*.
+
+    The wrapped handler holds the indices: reading, snapshotting, merging
+    and batch methods go straight to it, and values are read, merged,
+    copied, weighed and encoded with its methods. Subclasses change how
+    records reach it.
+    """
+
+    def __init__(self, handler, level=logging.NOTSET):
+        StatzHandler.__init__(self, level=level)
+        self.handler = handler
+
+    def getdata(self):
+        return self.handler.getdata()
+
+    def swapdata(self):
+        return self.handler.swapdata()
+
+    def copydata(self):
+        return self.handler.copydata()
+
+    def mergedata(self, data):
+        self.handler.mergedata(data)
+
+    def emitmany(self, values, index=None, indices=()):
+        """Aggregate a batch directly in the wrapped handler."""
+        self.handler.emitmany(values, index=index, indices=indices)
+
+    def emitcolumns(self, indices, values):
+        """Aggregate a batch directly in the wrapped handler."""
+        self.handler.emitcolumns(indices, values)
+
+    def counter(self, index=None):
+        """Return the wrapped handler's :meth:`~StatzHandler.counter`."""
+        return self.handler.counter(index)
+
+    def readvalue(self, value):
+        return self.handler.readvalue(value)
+
+    def mergevalue(self, value, other):
+        return self.handler.mergevalue(value, other)
+
+    def copyvalue(self, value):
+        return self.handler.copyvalue(value)
+
+    def getkind(self):
+        return self.handler.getkind()
+
+    def dumpvalue(self, value):
+        return self.handler.dumpvalue(value)
+
+    def loadvalue(self, value):
+        return self.handler.loadvalue(value)
+
+    def weighvalue(self, value):
+        return self.handler.weighvalue(value)
+
+    def prepare(self, record):
+        """Return a record's indices and value for the wrapped handler.
+
+        Return None if the wrapped handler's filters (such as its
+        :class:`Sampler`) reject the record.
+        """
+        handler = self.handler
+        if not handler.filter(record):
+            return None
+        return handler.getindices(record), handler.getvalue(record)
+
+    def apply(self, items):
+        """Aggregate (indices, value) pairs in the wrapped handler.
+
+        The pairs are applied under one acquisition of the wrapped
+        handler's lock, with :meth:`~StatzHandler.track` called after each
+        update as in :meth:`~StatzHandler.emit`, so *maxindices* and
+        *ordered* still apply.
+        """
+        handler = self.handler
+        handler.acquire()
+        try:
+            for indices, value in items:
+                try:
+                    for index in indices:
+                        handler.emitvalue(value, index)
+                        if handler.tracking:
+                            handler.track(index)
+                except Exception:
+                    log.exception("failed to aggregate a value")
+        finally:
+            handler.release()
+
+class Queued(Wrapper):
+    """Aggregate another handler's records on a background thread.
+
+    :meth:`emit` only works out a record's indices and value (see
+    :meth:`~Wrapper.prepare`) and puts them on a queue; it never takes
+    the wrapped handler's lock. A daemon thread drains the queue in batches
+    and applies each batch to *handler* under a single lock acquisition.
+    Parameters:
+
+        * *handler* the :class:`StatzHandler` that aggregates the values
+        * *size* maximum number of queued records, or 0 for no limit
+        * *overflow* "block" to wait for room when the queue is full, or
+          "drop" to discard the record and count it in *dropped*
+        * *batch* maximum number of records applied per lock acquisition
+
+    *indices* are those of the wrapped handler; call :meth:`flush` first to
+    include records that are still queued.
+    """
+    stop = object()
+
+    def __init__(self, handler, level=logging.NOTSET, size=0,
+            overflow="block", batch=256):
+        Wrapper.__init__(self, handler, level=level)
+        if overflow not in ("block", "drop"):
+            raise ValueError("overflow must be 'block' or 'drop'")
+        self.overflow = overflow
+        self.batch = batch
+        self.dropped = 0
+        self.queue = queue.Queue(size)
+        self.thread = threading.Thread(target=self.aggregate,
+            name="statzlogger-queued")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def handle(self, record):
+        """Filter and enqueue a record without taking the handler lock."""
+        rv = self.filter(record)
+        if rv:
+            self.emit(record)
+        return rv
+
+    def emit(self, record):
+        try:
+            item = self.prepare(record)
+        except Exception:
+            self.handleError(record)
+            return
+        if item is None:
+            return
+        if self.overflow == "block":
+            self.queue.put(item)
+            return
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self.acquire()
+            try:
+                self.dropped += 1
+            finally:
+                self.release()
+
+    def aggregate(self):
+        """Apply queued values to the wrapped handler until closed."""
+        get = self.queue.get
+        while True:
+            items = [get()]
+            try:
+                while len(items) < self.batch:
+                    items.append(get(False))
+            except queue.Empty:
+                pass
+            self.apply(item for item in items if item is not self.stop)
+            for item in items:
+                self.queue.task_done()
+            if self.stop in items:
+                return
+
+    def flush(self):
+        """Wait until every queued record has been aggregated."""
+        if self.thread.is_alive():
+            self.queue.join()
+
+    def close(self):
+        """Aggregate the queued records and stop the background thread."""
+        if self.thread.is_alive():
+            self.queue.put(self.stop)
+            self.thread.join()
+        StatzHandler.close(self)
+
+class Async(Wrapper):
+    """Aggregate another handler's records in :mod:`asyncio` callbacks.
+
+    :meth:`emit` only works out a record's indices and value and appends
+    them to a buffer; it takes no lock, so it is meant to be called from a
+    single event loop. The first record of a batch schedules a callback on
+    the running loop that applies up to *batch* buffered records to the
+    wrapped *handler* under one lock acquisition, then reschedules itself
+    if more are waiting, so other tasks run between batches. Records
+    emitted while no loop is running are aggregated at once.
+
+    *indices* are those of the wrapped handler; call :meth:`flush` (or
+    ``await`` :meth:`aflush`) or use :meth:`asnapshot` to include records
+    that are still buffered.
+    """
+
+    def __init__(self, handler, level=logging.NOTSET, batch=256):
+        Wrapper.__init__(self, handler, level=level)
+        self.batch = batch
+        self.buffer = collections.deque()
+        self.scheduled = False
+
+    def handle(self, record):
+        """Filter and buffer a record without taking a lock."""
+        rv = self.filter(record)
+        if rv:
+            self.emit(record)
+        return rv
+
+    def emit(self, record):
+        try:
+            item = self.prepare(record)
+        except Exception:
+            self.handleError(record)
+            return
+        if item is None:
+            return
+        self.buffer.append(item)
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.drain()
+            return
+        if not self.scheduled:
+            self.scheduled = True
+            loop.call_soon(self.aggregate)
+
+    def aggregate(self):
+        """Apply a batch of buffered values, rescheduling if more remain."""
+        self.scheduled = False
+        self.drain(self.batch)
+        if self.buffer:
+            self.scheduled = True
+            asyncio.get_running_loop().call_soon(self.aggregate)
+
+    def drain(self, count=None):
+        """Apply up to *count* buffered values (all of them by default)."""
+        buffer = self.buffer
+        if count is None:
+            count = len(buffer)
+        items = []
+        while buffer and len(items) < count:
+            items.append(buffer.popleft())
+        self.apply(items)
+
+    def flush(self):
+        """Aggregate every buffered record at once."""
+        self.drain()
+
+    async def aflush(self):
+        """Aggregate every buffered record, yielding between batches."""
+        while self.buffer:
+            self.drain(self.batch)
+            await asyncio.sleep(0)
+
+    async def asnapshot(self, reset=False):
+        """Flush, then return the wrapped handler's :meth:`snapshot`."""
+        await self.aflush()
+        return self.handler.snapshot(reset=reset)
+
+    def close(self):
+        """Aggregate the buffered records."""
+        self.drain()
+        StatzHandler.close(self)
+
+class Sharded(Wrapper):
+    """Aggregate another handler's records in per-thread shards.
+
+    Each thread that emits through the wrapper gets its own
+    :meth:`~StatzHandler.clone` of *handler*, with its own lock, so threads
+    never wait for each other on the emit path. Reading *indices* merges
+    the shards with the wrapped handler's :meth:`~StatzHandler.mergevalue`.
+    Shards of threads that have exited are kept, so no data is lost.
+    """
+
+    def __init__(self, handler, level=logging.NOTSET):
+        Wrapper.__init__(self, handler, level=level)
+        self.shards = []
+        self.local = threading.local()
+
+    def shard(self):
+        """Return the calling thread's shard, creating it if necessary."""
+        try:
+            return self.local.shard
+        except AttributeError:
+            pass
+        shard = self.local.shard = self.handler.clone()
+        self.acquire()
+        try:
+            self.shards.append(shard)
+        finally:
+            self.release()
+        return shard
+
+    def handle(self, record):
+        """Filter a record and pass it to the calling thread's shard."""
+        rv = self.filter(record)
+        if rv:
+            self.shard().handle(record)
+        return rv
+
+    def emit(self, record):
+        self.shard().emit(record)
+
+    def counter(self, index=None):
+        """Return a function that adds a value to *index* in the calling
+        thread's shard."""
+        local = threading.local()
+
+        def add(value=1):
+            try:
+                count = local.count
+            except AttributeError:
+                count = local.count = self.shard().counter(index)
+            count(value)
+
+        return add
+
+    def getdata(self):
+        handler = self.handler
+        merged = {}
+        for shard in list(self.shards):
+            shard.acquire()
+            try:
+                for index, value in shard.getdata().items():
+                    if index in merged:
+                        merged[index] = handler.mergevalue(merged[index], value)
+                    else:
+                        merged[index] = handler.copyvalue(value)
+            finally:
+                shard.release()
+        return merged
+
+    def copydata(self):
+        return self.getdata()
+
+    def swapdata(self):
+        handler = self.handler
+        merged = {}
+        for shard in list(self.shards):
+            for index, value in shard.swapdata().items():
+                if index in merged:
+                    merged[index] = handler.mergevalue(merged[index], value)
+                else:
+                    merged[index] = value
+        return merged
+
+    def mergedata(self, data):
+        self.shard().mergedata(data)
+
+    def emitmany(self, values, index=None, indices=()):
+        self.shard().emitmany(values, index=index, indices=indices)
+
+    def emitcolumns(self, indices, values):
+        self.shard().emitcolumns(indices, values)
+
+    def emitrecords(self, records):
+        self.shard().emitrecords(records)
+
+class Window(Wrapper):
+    """Aggregate another handler's records over a rolling time window.
+
+    Time is divided into intervals of *interval* seconds and each interval
+    is aggregated in its own bucket, an empty :meth:`~StatzHandler.clone` of
+    *handler*. A ring of *size* buckets is kept; when a record arrives for a
+    new interval, the bucket it reuses is emptied in O(1). Records are
+    placed by their *created* timestamp, and records older than the window
+    are dropped.
+
+    Reading *indices* merges the buckets of the last *size* intervals (a
+    sliding window); :meth:`query` merges a shorter span. With a *size* of
+    1, the window tumbles: it only holds the current interval.
+    """
+
+    def __init__(self, handler, level=logging.NOTSET, interval=60.0, size=1):
+        Wrapper.__init__(self, handler, level=level)
+        self.interval = interval
+        self.size = size
+        self.buckets = [handler.clone() for i in range(size)]
+        self.epochs = [None] * size
+
+    def bucket(self, created):
+        """Return the bucket for a timestamp, or None if it is too old."""
+        epoch = int(created // self.interval)
+        slot = epoch % self.size
+        current = self.epochs[slot]
+        if current != epoch:
+            if current is not None and current > epoch:
+                return None
+            self.buckets[slot].cleardata()
+            self.epochs[slot] = epoch
+        return self.buckets[slot]
+
+    def emit(self, record):
+        bucket = self.bucket(record.created)
+        if bucket is not None and self.handler.filter(record):
+            bucket.emit(record)
+
+    def emitmany(self, values, index=None, indices=()):
+        """Aggregate a batch in the bucket for the current time."""
+        self.acquire()
+        try:
+            self.bucket(time.time()).emitmany(values, index=index,
+                indices=indices)
+        finally:
+            self.release()
+
+    def emitcolumns(self, indices, values):
+        """Aggregate a batch in the bucket for the current time."""
+        self.acquire()
+        try:
+            self.bucket(time.time()).emitcolumns(indices, values)
+        finally:
+            self.release()
+
+    def counter(self, index=None):
+        """Return a function that adds a value to *index* in the bucket for
+        the current time."""
+        def add(value=1):
+            self.acquire()
+            try:
+                bucket = self.bucket(time.time())
+                bucket.emitvalue(value, index)
+                if bucket.tracking:
+                    bucket.track(index)
+            finally:
+                self.release()
+
+        return add
+
+    def query(self, span=None, now=None):
+        """Return the indices aggregated over the last *span* seconds.
+
+        *span* is rounded up to whole intervals and defaults to the whole
+        window; *now* defaults to the current time.
+        """
+        return Indices(self.getdata(span, now), self.readvalue)
+
+    def getdata(self, span=None, now=None):
+        if now is None:
+            now = time.time()
+        count = self.size
+        if span is not None:
+            count = min(count, int(math.ceil(float(span) / self.interval)))
+        last = int(now // self.interval)
+        handler = self.handler
+        merged = {}
+        self.acquire()
+        try:
+            for epoch, bucket in zip(self.epochs, self.buckets):
+                if epoch is None or not last - count < epoch <= last:
+                    continue
+                for index, value in bucket.getdata().items():
+                    if index in merged:
+                        merged[index] = handler.mergevalue(merged[index], value)
+                    else:
+                        merged[index] = handler.copyvalue(value)
+        finally:
+            self.release()
+        return merged
+
+    def copydata(self):
+        return self.getdata()
+
+    def swapdata(self):
+        self.acquire()
+        try:
+            data = self.getdata()
+            for bucket in self.buckets:
+                bucket.cleardata()
+        finally:
+            self.release()
+        return data
+
+    def mergedata(self, data):
+        self.acquire()
+        try:
+            self.bucket(time.time()).mergedata(data)
+        finally:
+            self.release()
+
+class Shipper(object):
+    """Send pre-aggregated deltas of some handlers to a :class:`Collector`.
+
+    Each time :meth:`ship` runs, every handler's indices are swapped out
+    (see :meth:`StatzHandler.swapdata`) and sent as a single message over
+    *connection*, a :mod:`multiprocessing` connection returned by
+    :meth:`Collector.pipe` or :func:`multiprocessing.connection.Client`.
+    The message holds each handler's name followed by its indices in the
+    binary format of :meth:`StatzHandler.dump`. Individual records never
+    cross the connection. Parameters:
+
+        * *connection* the connection to the collector
+        * *handlers* a dictionary mapping names to handlers
+        * *interval* seconds between shipments once :meth:`start` is called
+    """
+
+    def __init__(self, connection, handlers, interval=1.0):
+        self.connection = connection
+        self.handlers = handlers
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def ship(self):
+        """Send the deltas accumulated since the last shipment."""
+        message = io.BytesIO()
+        for name, handler in self.handlers.items():
+            data = handler.swapdata()
+            if data:
+                encode(name, message.write)
+                handler.dumpdata(message, data)
+        if message.tell():
+            self.connection.send_bytes(message.getvalue())
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.ship()
+
+    def start(self):
+        """Ship deltas every *interval* seconds on a daemon thread."""
+        self.thread = threading.Thread(target=self.run,
+            name="statzlogger-shipper")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        """Stop shipping, send the final deltas and close the connection."""
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.ship()
+        self.connection.close()
+
+class Collector(object):
+    """Combine the deltas sent by :class:`Shipper` instances.
+
+    Deltas are merged into *handlers*, a dictionary mapping names to
+    handlers, with :meth:`StatzHandler.mergedata`; names must match those
+    used by the shippers. Connections come from :meth:`pipe` (for child
+    processes) or :meth:`listen` (for a local UNIX socket).
+    """
+
+    def __init__(self, handlers):
+        self.handlers = handlers
+        self.connections = []
+        self.listener = None
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def pipe(self):
+        """Return the sending end of a new pipe for a child process."""
+        reader, writer = multiprocessing.Pipe(False)
+        self.addconnection(reader)
+        return writer
+
+    def addconnection(self, connection):
+        self.lock.acquire()
+        try:
+            self.connections.append(connection)
+        finally:
+            self.lock.release()
+
+    def listen(self, address, family=None):
+        """Accept shippers' connections on *address* in a daemon thread."""
+        self.listener = multiprocessing.connection.Listener(address, family)
+        self.spawn(self.accept, "statzlogger-listener")
+
+    def accept(self):
+        while not self.stopped.is_set():
+            try:
+                connection = self.listener.accept()
+            except (OSError, EOFError):
+                return
+            self.addconnection(connection)
+
+    def collect(self, timeout=0):
+        """Merge the deltas that arrive within *timeout* seconds.
+
+        Return the number of messages merged. A connection that sends a
+        message that can't be merged (a corrupt stream, or indices of the
+        wrong kind) is logged and closed; the others carry on.
+        """
+        self.lock.acquire()
+        try:
+            connections = list(self.connections)
+        finally:
+            self.lock.release()
+        if not connections:
+            self.stopped.wait(timeout)
+            return 0
+        merged = 0
+        for connection in multiprocessing.connection.wait(connections, timeout):
+            try:
+                message = connection.recv_bytes()
+            except (EOFError, OSError):
+                self.removeconnection(connection)
+                continue
+            try:
+                self.mergemessage(io.BytesIO(message), len(message))
+            except Exception:
+                log.exception("dropping a shipper that sent a bad message")
+                self.removeconnection(connection)
+                continue
+            merged += 1
+        return merged
+
+    def mergemessage(self, message, size):
+        """Merge every handler's stream in a message from a shipper."""
+        while message.tell() < size:
+            name = decode(message.read)
+            handler = self.handlers.get(name)
+            if handler is not None:
+                handler.load(message)
+            else:
+                for record in readstream(message)[1]:
+                    pass
+
+    def removeconnection(self, connection):
+        self.lock.acquire()
+        try:
+            self.connections.remove(connection)
+        finally:
+            self.lock.release()
+        connection.close()
+
+    def run(self, interval):
+        while not self.stopped.is_set():
+            self.collect(interval)
+
+    def start(self, interval=0.1):
+        """Collect deltas continuously on a daemon thread."""
+        self.thread = self.spawn(lambda: self.run(interval),
+            "statzlogger-collector")
+
+    def spawn(self, target, name):
+        thread = threading.Thread(target=target, name=name)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def close(self):
+        """Stop collecting and close every connection."""
+        self.stopped.set()
+        if self.listener is not None:
+            self.listener.close()
+        if self.thread is not None:
+            self.thread.join()
+        for connection in list(self.connections):
+            self.removeconnection(connection)
+
+class Exporter(object):
+    """Periodically export snapshots of some handlers to sinks.
+
+    Each export takes a :meth:`~StatzHandler.snapshot` of every handler in
+    *handlers* (a dictionary mapping names to handlers) and hands the batch
+    of (name, handler, snapshot) triples to every sink. A sink is either a
+    callable or an object with a *write* method taking the batch, such as
+    :class:`FileSink` or :class:`StatsdSink`.
+
+    Exports run on a timer thread (:meth:`start`) or an :mod:`asyncio` task
+    (:meth:`run`), never on the emit path. When a sink fails, its batches
+    are kept (at most *pending* of them) and retried at the next export
+    after a delay that doubles with each failure, up to *backoff* seconds.
+    Parameters:
+
+        * *handlers* a dictionary mapping names to handlers
+        * *sinks* a list of sinks
+        * *interval* seconds between exports
+        * *reset* whether each export empties the handlers
+        * *pending* batches kept per failing sink
+        * *backoff* longest delay between retries of a failing sink
+        * *metrics* whether to add each handler's :meth:`~StatzHandler.metrics`
+          to the batch, named after the handler with a ".metrics" suffix
+    """
+
+    def __init__(self, handlers, sinks, interval=10.0, reset=True, pending=10,
+            backoff=60.0, metrics=False):
+        self.handlers = handlers
+        self.metrics = metrics
+        self.plain = StatzHandler()
+        self.sinks = [ExportQueue(sink, pending, backoff) for sink in sinks]
+        self.interval = interval
+        self.reset = reset
+        self.stopped = threading.Event()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def export(self, now=None):
+        """Snapshot the handlers and deliver the batch to every sink."""
+        if now is None:
+            now = time.time()
+        batch = [(name, handler, handler.snapshot(reset=self.reset))
+            for name, handler in self.handlers.items()]
+        if self.metrics:
+            batch.extend((name + ".metrics", self.plain,
+                Indices(handler.metrics(), self.plain.readvalue))
+                for name, handler in self.handlers.items())
+        self.lock.acquire()
+        try:
+            for sink in self.sinks:
+                sink.deliver(batch, now)
+        finally:
+            self.lock.release()
+
+    def loop(self):
+        while not self.stopped.wait(self.interval):
+            self.export()
+
+    def start(self):
+        """Export every *interval* seconds on a daemon thread."""
+        self.thread = threading.Thread(target=self.loop,
+            name="statzlogger-exporter")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        """Stop the timer thread and run a final export."""
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.export()
+
+    def run(self):
+        """Return a coroutine that exports every *interval* seconds.
+
+        Exports run in the event loop's default executor so that slow sinks
+        do not block the loop. Cancel the task to stop it.
+        """
+        async def run():
+            loop = asyncio.get_running_loop()
+            while True:
+                await asyncio.sleep(self.interval)
+                await loop.run_in_executor(None, self.export)
+
+        return run()
+
+class ExportQueue(object):
+    """Batches waiting for delivery to a sink, retried with backoff."""
+
+    def __init__(self, sink, pending=10, backoff=60.0):
+        self.sink = sink
+        self.write = getattr(sink, "write", sink)
+        self.batches = collections.deque(maxlen=pending)
+        self.backoff = backoff
+        self.failures = 0
+        self.retry = 0
+
+    def deliver(self, batch, now):
+        """Queue *batch* and write every queued batch if the sink is due."""
+        self.batches.append(batch)
+        if now < self.retry:
+            return
+        while self.batches:
+            try:
+                self.write(self.batches[0])
+            except Exception:
+                self.failures += 1
+                delay = min(self.backoff, 2 ** (self.failures - 1))
+                self.retry = now + delay
+                log.exception("failed to export to %r; retrying in %ds",
+                    self.sink, delay)
+                return
+            self.batches.popleft()
+            self.failures = 0
+            self.retry = 0
+
+class FileSink(object):
+    """Append exported batches to a file.
+
+    With the "json" *format*, each index becomes a line holding a JSON
+    object with the export time, the handler name, the index and its value
+    (sets become lists; other unsupported values become strings). With the
+    "binary" format, each handler's indices are appended as its name
+    (see :func:`encode`) followed by a stream written by
+    :meth:`StatzHandler.dumpdata`. Writes are buffered and flushed once per
+    batch.
+    """
+
+    def __init__(self, path, format="json"):
+        if format not in ("json", "binary"):
+            raise ValueError("format must be 'json' or 'binary'")
+        self.path = path
+        self.format = format
+        self.file = None
+
+    def write(self, batch):
+        if self.file is None:
+            self.file = open(self.path, "ab")
+        if self.format == "binary":
+            for name, handler, snapshot in batch:
+                encode(name, self.file.write)
+                handler.dumpdata(self.file, snapshot.data)
+        else:
+            now = time.time()
+            for name, handler, snapshot in batch:
+                for index, value in snapshot.items():
+                    line = json.dumps(dict(time=now, handler=name, index=index,
+                        value=value), default=self.jsonvalue)
+                    self.file.write(line.encode("utf-8") + b"\n")
+        self.file.flush()
+
+    def jsonvalue(self, value):
+        if isinstance(value, (set, frozenset)):
+            return sorted(value, key=repr)
+        return repr(value)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+class StatsdSink(object):
+    """Send exported batches to a statsd server over UDP or a UNIX socket.
+
+    Each numeric value becomes a line like "prefix.name.index:value|g";
+    dictionaries (from :class:`Summary` or :class:`Quantile`) add their keys
+    to the metric name, and other sized values are sent as their length.
+    Lines are packed into datagrams of at most *size* bytes. Parameters:
+
+        * *address* a (host, port) pair, or the path of a UNIX socket
+        * *prefix* prepended to every metric name
+        * *metric* statsd metric type, such as "g" or "c"
+        * *size* maximum datagram size
+    """
+    unsafe = re.compile(r"[^A-Za-z0-9_.-]")
+
+    def __init__(self, address, prefix="", metric="g", size=1432):
+        self.address = address
+        self.prefix = prefix
+        self.metric = metric
+        self.size = size
+        if isinstance(address, str):
+            family = socket.AF_UNIX
+        else:
+            family = socket.AF_INET
+        self.socket = socket.socket(family, socket.SOCK_DGRAM)
+
+    def lines(self, batch):
+        """Yield the statsd lines for a batch."""
+        for name, handler, snapshot in batch:
+            for index, value in snapshot.items():
+                parts = [self.prefix, name, str(index)]
+                for key, number in self.numbers(value):
+                    metric = ".".join(self.unsafe.sub("_", part)
+                        for part in parts + key if part)
+                    yield "%s:%r|%s" % (metric, number, self.metric)
+
+    def numbers(self, value, key=()):
+        if isinstance(value, bool):
+            yield list(key), int(value)
+        elif isinstance(value, (int, float)):
+            yield list(key), value
+        elif isinstance(value, dict):
+            for name, item in sorted(value.items(), key=repr):
+                if item is not None:
+                    for pair in self.numbers(item, key + (str(name),)):
+                        yield pair
+        elif hasattr(value, "__len__"):
+            yield list(key), len(value)
+
+    def write(self, batch):
+        datagram = []
+        length = 0
+        for line in self.lines(batch):
+            line = line.encode("utf-8")
+            if datagram and length + len(line) + 1 > self.size:
+                self.socket.sendto(b"\n".join(datagram), self.address)
+                datagram, length = [], 0
+            datagram.append(line)
+            length += len(line) + 1
+        if datagram:
+            self.socket.sendto(b"\n".join(datagram), self.address)
+
+    def close(self):
+        self.socket.close()
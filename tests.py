@@ -1,5 +1,10 @@
 import unittest
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 class FakeRecord(object):
 
     def __init__(self, msg, extra={}):
@@ -140,6 +145,19 @@ class CollectionTests(unittest.TestCase):
         obj.emitvalue([1], "index")
         self.assertEqual(obj.indices, {"index": [1, 1]})
 
+    def test_emitvalue_default(self):
+        obj = self.init(default=[0])
+        obj.emitvalue([1], "index1")
+        obj.emitvalue([2], "index2")
+        self.assertEqual(obj.indices, {"index1": [0, 1], "index2": [0, 2]})
+        self.assertEqual(obj.default, [0])
+
+    def test_emitvalue_op(self):
+        obj = self.init(default=(), op=lambda x, y: x + tuple(y))
+        obj.emitvalue([1], "index")
+        obj.emitvalue([2], "index")
+        self.assertEqual(obj.indices, {"index": (1, 2)})
+
 class MaximumTests(unittest.TestCase):
 
     def cls(self):
@@ -191,6 +209,124 @@ class MaximumTests(unittest.TestCase):
         self.assertEqual(obj.indices["index"][0], ("value4", 4))
         self.assertEqual(obj.indices["index"][-1], ("value2", 2))
 
+    def test_emitvalue_ties(self):
+        obj = self.init(size=2)
+        for value in ("first", "second", "third"):
+            obj.emitvalue([(value, 1)], "index")
+
+        self.assertEqual(obj.indices["index"], [("first", 1), ("second", 1)])
+
+    def test_emitvalue_matches_sort(self):
+        import random
+        rand = random.Random(0)
+        obj = self.init(size=5)
+        expected = []
+        for i in range(200):
+            pair = (object(), rand.randint(0, 20))
+            obj.emitvalue([pair], "index")
+            expected = sorted(expected + [pair],
+                key=lambda p: p[1], reverse=obj.reverse)[:5]
+
+        self.assertEqual(obj.indices["index"], expected)
+    def test_weight_once_per_record(self):
+        calls = []
+        def weight(value):
+            calls.append(value)
+            return value
+        obj = self.init(size=2, weight=weight)
+        obj.handle(FakeRecord(3, dict(indices=["a", "b", "c"])))
+        self.assertEqual(calls, [3])
+        self.assertEqual(obj.indices["c"], [(3, 3)])
+
+    def test_compact_matches_heap(self):
+        import random
+        from statzlogger import BoundedArray, BoundedHeap
+        rng = random.Random(3)
+        for reverse in (True, False):
+            for size in (None, 0, 1, 5):
+                heap, compact = BoundedHeap(size, reverse), BoundedArray(size,
+                    reverse)
+                for i in range(200):
+                    weight = rng.choice([rng.randint(0, 9), rng.random()])
+                    heap.push(i, weight)
+                    compact.push(i, weight)
+                self.assertEqual(compact.items(), heap.items())
+                self.assertEqual(len(compact), len(heap))
+
+    def test_compact_memory(self):
+        from statzlogger import BoundedArray, BoundedHeap, sizeof
+        heap, compact = BoundedHeap(1000), BoundedArray(1000)
+        for i in range(1000):
+            heap.push(None, i)
+            compact.push(None, i)
+        self.assertTrue(sizeof(compact) * 3 < sizeof(heap))
+
+    def test_weight_types(self):
+        obj = self.init(size=2)
+        obj.handle(FakeRecord("a", dict(weight=2)))
+        obj.handle(FakeRecord("b", dict(weight=3)))
+        self.assertEqual([type(w) for v, w in obj.indices[None]], [int, int])
+        obj.handle(FakeRecord("c", dict(weight=2.5)))
+        self.assertEqual(obj.indices[None], [("b", 3), ("c", 2.5)])
+
+    def test_weight_types_evicted(self):
+        obj = self.init(size=1)
+        for value, weight in (("a", 2.5), ("b", 3), ("c", 4)):
+            obj.handle(FakeRecord(value, dict(weight=weight)))
+        self.assertEqual(obj.indices[None], [("c", 4)])
+        self.assertEqual(type(obj.indices[None][0][1]), int)
+
+    def test_weight_fallback(self):
+        from fractions import Fraction
+        obj = self.init(size=2)
+        obj.handle(FakeRecord("a", dict(weight=1)))
+        obj.handle(FakeRecord("b", dict(weight=2 ** 60 + 1)))
+        obj.handle(FakeRecord("c", dict(weight=3)))
+        self.assertEqual(obj.indices[None], [("b", 2 ** 60 + 1), ("c", 3)])
+
+        obj = self.init(size=2)
+        obj.emitmany(["x", "y", "z"], index="a")
+        obj.handle(FakeRecord("w", dict(index="a", weight=Fraction(4, 3))))
+        self.assertEqual(obj.indices["a"], [("w", Fraction(4, 3)), ("x", 1)])
+
+    def test_weight_types_preserved(self):
+        from decimal import Decimal
+        from fractions import Fraction
+        weights = [Fraction(3, 2), Decimal("1.5"), True, 2.5, 7]
+        if numpy is not None:
+            weights.append(numpy.int64(3))
+        for weight in weights:
+            obj = self.init(size=2)
+            obj.handle(FakeRecord("a", dict(weight=weight)))
+            obj.handle(FakeRecord("b", dict(weight=weight)))
+            ((value, kept), _) = obj.indices[None]
+            self.assertEqual(type(kept), type(weight))
+            self.assertEqual(kept, weight)
+
+    def test_merge_fallback(self):
+        from fractions import Fraction
+        first, second = self.init(size=2), self.init(size=2)
+        first.handle(FakeRecord("a", dict(weight=1)))
+        second.handle(FakeRecord("b", dict(weight=Fraction(1, 3))))
+        second.handle(FakeRecord("c", dict(weight=Fraction(5, 3))))
+        first.merge(second)
+        self.assertEqual(first.indices[None],
+            [("c", Fraction(5, 3)), ("a", 1)])
+
+    def test_dump_load(self):
+        import io
+        obj = self.init(size=3)
+        for i in range(10):
+            obj.handle(FakeRecord(i, dict(weight=i % 4)))
+        stream = io.BytesIO()
+        obj.dump(stream)
+        stream.seek(0)
+        other = self.init(size=3)
+        other.load(stream)
+        self.assertEqual(other.indices, obj.indices)
+        other.handle(FakeRecord("new", dict(weight=3)))
+        self.assertEqual(other.indices[None], [(3, 3), (7, 3), ("new", 3)])
+
 class MinimumTests(unittest.TestCase):
 
     def cls(self):
@@ -210,6 +346,13 @@ class MinimumTests(unittest.TestCase):
         self.assertEqual(len(obj.indices["index"]), 2)
         self.assertEqual(obj.indices["index"][0], ("value1", 1))
 
+    def test_emitvalue_size(self):
+        obj = self.init(size=2)
+        for i in (3, 1, 2, 1, 0):
+            obj.emitvalue([("value%d" % i, i)], "index")
+
+        self.assertEqual(obj.indices["index"], [("value0", 0), ("value1", 1)])
+
 class SetTests(unittest.TestCase):
 
     def cls(self):
@@ -218,6 +361,12 @@ class SetTests(unittest.TestCase):
     
     def init(self, *args, **kwargs):
         return self.cls()(*args, **kwargs)
+
+    def test_emit_shared_value(self):
+        obj = self.init()
+        obj.handle(FakeRecord("a", dict(indices=["x", "y"])))
+        obj.handle(FakeRecord("b", dict(index="x")))
+        self.assertEqual(obj.indices, dict(x=set("ab"), y=set("a")))
     
     def test_getvalue_str(self):
         obj = self.init()
@@ -253,6 +402,1529 @@ class SetTests(unittest.TestCase):
         obj.emitvalue(["value"], "index")
         self.assertTrue(len(obj.indices), 0)
 
+    def test_emitvalue_op(self):
+        obj = self.init(op=frozenset.union, default=frozenset())
+        obj.emitvalue(["value1"], "index")
+        obj.emitvalue(["value2"], "index")
+        self.assertEqual(obj.indices["index"], frozenset(["value1", "value2"]))
+
+    def test_emitmany_seq(self):
+        obj = self.init()
+        obj.emitmany([["one", "two"], "three"], index="index")
+        obj.handle(FakeRecord(["four"], dict(index="index")))
+        self.assertEqual(obj.indices["index"], set(["one", "two", "three",
+            "four"]))
+
+    def test_emitmany_op(self):
+        obj = self.init(op=frozenset.union, default=frozenset())
+        obj.emitmany([["one", "two"], "three"], index="index")
+        self.assertEqual(obj.indices["index"], frozenset(["one", "two",
+            "three"]))
+
+    def test_merge_size(self):
+        obj = self.init(size=2)
+        other = self.init()
+        obj.emitvalue(["a", "b"], "x")
+        obj.emitvalue(["a"], "y")
+        other.emitvalue(["c"], "x")
+        other.emitvalue(["a", "b", "c"], "z")
+        obj.merge(other)
+        self.assertEqual(obj.indices, dict(y=set("a")))
+
+class TopTests(unittest.TestCase):
+
+    def cls(self):
+        from statzlogger import Top as cls
+        return cls
+
+    def init(self, *args, **kwargs):
+        return self.cls()(*args, **kwargs)
+
+    def test_getvalue_weighted(self):
+        obj = self.init()
+        record = FakeRecord("value", extra=dict(weight=10))
+        value = obj.getvalue(record)
+        self.assertEqual(value, [("value", 10)])
+
+    def test_init_error(self):
+        obj = self.init(error=0.01)
+        self.assertEqual(obj.size, 100)
+
+    def test_emitvalue(self):
+        obj = self.init()
+        obj.emitvalue([("value1", 1)], "index")
+        obj.emitvalue([("value2", 1)], "index")
+        obj.emitvalue([("value2", 1)], "index")
+        self.assertEqual(obj.indices["index"], [("value2", 2), ("value1", 1)])
+
+    def test_emitvalue_size(self):
+        obj = self.init(size=2)
+        obj.emitvalue([("value1", 3)], "index")
+        obj.emitvalue([("value2", 1)], "index")
+        obj.emitvalue([("value3", 1)], "index")
+        self.assertEqual(obj.indices["index"], [("value1", 3), ("value3", 2)])
+        self.assertEqual(obj.bounds("index"),
+            [("value1", 3, 3), ("value3", 1, 2)])
+
+    def test_emitvalue_heavy_hitters(self):
+        obj = self.init(size=10)
+        for i in range(1000):
+            obj.emitvalue([("noise%d" % i, 1)], "index")
+            if i % 4 == 0:
+                obj.emitvalue([("heavy", 1)], "index")
+
+        self.assertEqual(len(obj.data["index"]), 10)
+        value, count = obj.indices["index"][0]
+        self.assertEqual(value, "heavy")
+        self.assertTrue(250 <= count <= 250 + 1250 / 10)
+
+class UniqueTests(unittest.TestCase):
+
+    def cls(self):
+        from statzlogger import Unique as cls
+        return cls
+
+    def init(self, *args, **kwargs):
+        return self.cls()(*args, **kwargs)
+
+    def test_emitvalue(self):
+        obj = self.init()
+        obj.emitvalue("value", "index")
+        obj.emitvalue("value", "index")
+        obj.emitvalue("other", "index")
+        self.assertEqual(obj.indices, {"index": 2})
+
+    def test_emitvalue_many(self):
+        obj = self.init(precision=12)
+        for i in range(20000):
+            obj.emitvalue(i, "index")
+            obj.emitvalue(i, "index")
+
+        self.assertEqual(len(obj.data["index"].registers), 4096)
+        self.assertTrue(abs(obj.indices["index"] - 20000) < 20000 * 0.05)
+
+    def test_merge(self):
+        from statzlogger import HyperLogLog
+        first, second = HyperLogLog(), HyperLogLog()
+        for i in range(5000):
+            first.add(i)
+            second.add(i + 2500)
+        first.merge(second)
+        self.assertTrue(abs(first.estimate() - 7500) < 7500 * 0.05)
+
+    def test_merge_precision(self):
+        from statzlogger import HyperLogLog
+        self.assertRaises(ValueError, HyperLogLog(10).merge, HyperLogLog(12))
+
+class QuantileTests(unittest.TestCase):
+
+    def cls(self):
+        from statzlogger import Quantile as cls
+        return cls
+
+    def init(self, *args, **kwargs):
+        return self.cls()(*args, **kwargs)
+
+    def assertClose(self, value, expected, accuracy=0.01):
+        self.assertTrue(abs(value - expected) <= abs(expected) * accuracy,
+            "%r is not within %r of %r" % (value, accuracy, expected))
+
+    def test_emitvalue(self):
+        obj = self.init()
+        for i in range(1, 10001):
+            obj.emitvalue(i, "index")
+
+        quantiles = obj.indices["index"]
+        self.assertEqual(sorted(quantiles), [0.5, 0.95, 0.99])
+        self.assertClose(quantiles[0.5], 5000)
+        self.assertClose(quantiles[0.99], 9900)
+        self.assertClose(obj.quantile("index", 0.1), 1000)
+
+    def test_emitvalue_signs(self):
+        obj = self.init(quantiles=(0, 0.5, 1))
+        for value in (-100, -1, 0, 1, 100):
+            obj.emitvalue(value, "index")
+
+        quantiles = obj.indices["index"]
+        self.assertClose(quantiles[0], -100)
+        self.assertEqual(quantiles[0.5], 0)
+        self.assertClose(quantiles[1], 100)
+
+    def test_emitvalue_size(self):
+        obj = self.init(size=64)
+        for i in range(1, 100001):
+            obj.emitvalue(float(i), "index")
+
+        sketch = obj.data["index"]
+        self.assertTrue(len(sketch.positive) <= 64)
+        self.assertClose(obj.quantile("index", 0.99), 99000)
+
+    def test_merge(self):
+        from statzlogger import QuantileSketch
+        first, second = QuantileSketch(), QuantileSketch()
+        for i in range(1, 5001):
+            first.add(i)
+            second.add(i + 5000)
+        first.merge(second)
+        self.assertEqual(first.count, 10000)
+        self.assertClose(first.quantile(0.5), 5000)
+
+class QueuedTests(unittest.TestCase):
+
+    def cls(self):
+        from statzlogger import Queued as cls
+        return cls
+
+    def init(self, *args, **kwargs):
+        obj = self.cls()(*args, **kwargs)
+        self.addCleanup(obj.close)
+        return obj
+
+    def test_emit(self):
+        from statzlogger import Sum
+        obj = self.init(Sum(), batch=3)
+        for i in range(10):
+            obj.handle(FakeRecord(i, extra=dict(indices=("a", "b"))))
+
+        obj.flush()
+        self.assertEqual(obj.indices, {"a": 45, "b": 45})
+
+    def test_emit_drop(self):
+        from statzlogger import Sum
+        handler = Sum()
+        obj = self.init(handler, size=1, overflow="drop")
+        handler.acquire()
+        try:
+            for i in range(5):
+                obj.handle(FakeRecord(1))
+        finally:
+            handler.release()
+
+        obj.flush()
+        self.assertTrue(obj.dropped >= 3)
+        self.assertEqual(obj.indices[None] + obj.dropped, 5)
+
+    def test_close(self):
+        from statzlogger import Collection
+        obj = self.init(Collection())
+        obj.handle(FakeRecord("value"))
+        obj.close()
+        self.assertFalse(obj.thread.is_alive())
+        self.assertEqual(obj.indices, {None: ["value"]})
+    def test_tracking(self):
+        from statzlogger import Queued, Sum
+        evicted = []
+        handler = Sum(maxindices=2, onevict=lambda *args: evicted.append(args))
+        obj = Queued(handler)
+        for index in range(5):
+            obj.handle(FakeRecord(index, dict(index=index)))
+        obj.flush()
+        self.assertEqual(obj.indices, {3: 3, 4: 4})
+        self.assertEqual(handler.evicted, 3)
+        self.assertEqual(evicted, [(0, 0), (1, 1), (2, 2)])
+        obj.close()
+
+    def test_ordered(self):
+        from statzlogger import Queued, Sum
+        obj = Queued(Sum(ordered=True))
+        for index in range(5):
+            obj.handle(FakeRecord(index, dict(index=index)))
+        obj.flush()
+        self.assertEqual(obj.handler.total(), 10)
+        self.assertEqual(obj.handler.top(2), [(4, 4), (3, 3)])
+        obj.close()
+
+class AsyncTests(unittest.TestCase):
+
+    def run_loop(self, coroutine):
+        import asyncio
+        return asyncio.run(coroutine)
+
+    def test_emit_in_loop(self):
+        import asyncio
+        from statzlogger import Async, Sum
+        sum = Sum()
+        obj = Async(sum, batch=2)
+        async def main():
+            for i in range(5):
+                obj.handle(FakeRecord(1, dict(index="a")))
+            buffered = len(obj.buffer)
+            await asyncio.sleep(0)
+            partial = sum.indices.get("a")
+            snapshot = await obj.asnapshot()
+            return buffered, partial, dict(snapshot)
+        buffered, partial, snapshot = self.run_loop(main())
+
+        self.assertEqual(buffered, 5)
+        self.assertEqual(partial, 2)
+        self.assertEqual(snapshot, dict(a=5))
+
+    def test_flush(self):
+        from statzlogger import Async, Collection
+        obj = Async(Collection())
+        async def main():
+            for i in range(10):
+                obj.handle(FakeRecord(i, dict(index="a")))
+            await obj.aflush()
+            return obj.indices["a"]
+        self.assertEqual(self.run_loop(main()), list(range(10)))
+
+    def test_sync_flush(self):
+        import asyncio
+        from statzlogger import Async, Sum
+        obj = Async(Sum(maxindices=2, ordered=True))
+        async def main():
+            for index in range(5):
+                obj.handle(FakeRecord(index, dict(index=index)))
+            obj.flush()
+            return dict(obj.indices)
+        self.assertEqual(self.run_loop(main()), {3: 3, 4: 4})
+        self.assertEqual(obj.handler.evicted, 3)
+        self.assertEqual(obj.handler.total(), 7)
+
+    def test_emit_outside_loop(self):
+        from statzlogger import Async, Sum
+        obj = Async(Sum())
+        obj.handle(FakeRecord(3))
+        self.assertEqual(obj.indices, {None: 3})
+        self.assertEqual(len(obj.buffer), 0)
+
+class ShardedTests(unittest.TestCase):
+
+    def cls(self):
+        from statzlogger import Sharded as cls
+        return cls
+
+    def init(self, *args, **kwargs):
+        return self.cls()(*args, **kwargs)
+
+    def run_threads(self, obj, records, threads=4):
+        import threading
+        workers = [threading.Thread(target=lambda: [obj.handle(record)
+            for record in records]) for i in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return len(workers)
+
+    def test_emit_sum(self):
+        from statzlogger import Sum
+        obj = self.init(Sum())
+        self.run_threads(obj, [FakeRecord(1, extra=dict(index="index"))] * 100)
+        self.assertEqual(len(obj.shards), 4)
+        self.assertEqual(obj.indices, {"index": 400})
+
+    def test_emit_maximum(self):
+        from statzlogger import Maximum
+        obj = self.init(Maximum(size=2))
+        records = [FakeRecord(i, extra=dict(weight=i)) for i in range(10)]
+        self.run_threads(obj, records)
+        self.assertEqual(obj.indices[None], [(9, 9), (9, 9)])
+
+    def test_merge_set(self):
+        from statzlogger import Set
+        obj = self.init(Set())
+        self.run_threads(obj, [FakeRecord("a"), FakeRecord("b")])
+        self.assertEqual(obj.indices, {None: set(["a", "b"])})
+        for shard in obj.shards:
+            self.assertEqual(shard.indices, {None: set(["a", "b"])})
+
+    def test_merge_top(self):
+        from statzlogger import Top
+        handler = Top(size=2)
+        first, second = handler.clone(), handler.clone()
+        for value in "aab":
+            first.emitvalue([(value, 1)], None)
+        for value in "ccb":
+            second.emitvalue([(value, 1)], None)
+        merged = handler.mergevalue(first.data[None], second.data[None])
+        self.assertEqual(merged.total, 6)
+        self.assertEqual(sorted(merged.counts), ["a", "c"])
+
+class MergeTests(unittest.TestCase):
+
+    def test_merge_sum(self):
+        from statzlogger import Sum
+        first, second = Sum(), Sum()
+        first.emitvalue(1, "a")
+        second.emitvalue(2, "a")
+        second.emitvalue(3, "b")
+        first.merge(second)
+        self.assertEqual(first.indices, {"a": 3, "b": 3})
+        self.assertEqual(second.indices, {"a": 2, "b": 3})
+
+    def test_merge_maximum(self):
+        from statzlogger import Maximum
+        first, second = Maximum(size=2), Maximum(size=2)
+        first.emitvalue([("one", 1), ("three", 3)], None)
+        second.emitvalue([("two", 2)], None)
+        first.merge(second)
+        second.emitvalue([("four", 4)], None)
+        self.assertEqual(first.indices[None], [("three", 3), ("two", 2)])
+
+    def test_swapdata(self):
+        from statzlogger import Collection
+        obj = Collection()
+        obj.emitvalue([1], "index")
+        data = obj.swapdata()
+        self.assertEqual(data, {"index": [1]})
+        self.assertEqual(obj.indices, {})
+
+class SnapshotTests(unittest.TestCase):
+
+    def test_snapshot(self):
+        from statzlogger import Collection
+        obj = Collection()
+        obj.emitvalue([1], "index")
+        snapshot = obj.snapshot()
+        obj.emitvalue([2], "index")
+        self.assertEqual(snapshot, {"index": [1]})
+        self.assertEqual(obj.indices, {"index": [1, 2]})
+
+    def test_snapshot_copy_on_write(self):
+        from statzlogger import Collection
+        obj = Collection()
+        obj.emitvalue([1], "a")
+        obj.emitvalue([2], "b")
+        snapshot = obj.snapshot()
+        self.assertTrue(snapshot.data["a"] is obj.data["a"])
+        obj.emitvalue([3], "a")
+        obj.emitvalue([4], "a")
+        obj.mergedata({"b": [5]})
+        self.assertEqual(snapshot, {"a": [1], "b": [2]})
+        self.assertEqual(obj.indices, {"a": [1, 3, 4], "b": [2, 5]})
+        self.assertEqual(obj.shared, set())
+
+    def test_snapshot_modified(self):
+        from statzlogger import Collection, Set
+        obj = Collection()
+        obj.emitvalue([1], "a")
+        snapshot = obj.snapshot()
+        snapshot["a"].append(99)
+        self.assertEqual(snapshot["a"], [1])
+        self.assertEqual(obj.indices["a"], [1])
+        obj = Set()
+        obj.emitvalue(["x"], "a")
+        obj.snapshot()["a"].add("y")
+        self.assertEqual(obj.indices["a"], set(["x"]))
+
+    def test_set_indices(self):
+        from statzlogger import Sharded, Sum
+        obj = Sum(ordered=True, maxindices=2)
+        obj.emitvalue(5, "a")
+        snapshot = obj.snapshot()
+        obj.indices = {"b": 1}
+        self.assertEqual(obj.indices, {"b": 1})
+        self.assertEqual(obj.top(), [("b", 1)])
+        obj.emitvalue(1, "b")
+        obj.indices = {}
+        self.assertEqual(obj.indices, {})
+        self.assertEqual(obj.total(), 0)
+        self.assertEqual(snapshot, {"a": 5})
+        obj = Sharded(Sum())
+        obj.handle(FakeRecord(1))
+        obj.indices = {"c": 2}
+        self.assertEqual(obj.indices, {"c": 2})
+
+    def test_snapshot_reset(self):
+        from statzlogger import Maximum
+        obj = Maximum(size=2)
+        obj.emitvalue([("value", 1)], "index")
+        data = obj.data
+        snapshot = obj.snapshot(reset=True)
+        obj.emitvalue([("other", 2)], "index")
+        self.assertTrue(snapshot.data is data)
+        self.assertEqual(snapshot, {"index": [("value", 1)]})
+        self.assertEqual(obj.indices, {"index": [("other", 2)]})
+
+    def test_snapshot_readonly(self):
+        from statzlogger import Sum
+        obj = Sum()
+        obj.emitvalue(1, "index")
+        snapshot = obj.snapshot()
+        self.assertFalse(hasattr(snapshot, "__setitem__"))
+
+    def test_snapshot_sharded(self):
+        from statzlogger import Sharded, Sum
+        obj = Sharded(Sum())
+        obj.handle(FakeRecord(1))
+        self.assertEqual(obj.snapshot(reset=True), {None: 1})
+        self.assertEqual(obj.snapshot(), {})
+
+class CollectorTests(unittest.TestCase):
+
+    def cls(self):
+        from statzlogger import Collector as cls
+        return cls
+
+    def init(self, *args, **kwargs):
+        obj = self.cls()(*args, **kwargs)
+        self.addCleanup(obj.close)
+        return obj
+
+    def test_collect_pipe(self):
+        from statzlogger import Shipper, Sum
+        total = Sum()
+        obj = self.init({"requests": total})
+        children = [Sum(), Sum()]
+        for i, child in enumerate(children):
+            child.emitvalue(i + 1, "index")
+            shipper = Shipper(obj.pipe(), {"requests": child})
+            shipper.ship()
+            shipper.close()
+
+        self.assertEqual(obj.collect(timeout=1), 2)
+        self.assertEqual(total.indices, {"index": 3})
+        self.assertEqual(children[0].indices, {})
+
+        obj.collect(timeout=0.1)
+        self.assertEqual(obj.connections, [])
+
+    def test_bad_message(self):
+        import logging
+        import time
+        from statzlogger import Collection, Shipper, Sum
+        total = Sum()
+        obj = self.init({"requests": total})
+        wrong = Collection()
+        wrong.emitvalue([1], "index")
+        bad = Shipper(obj.pipe(), {"requests": wrong})
+        corrupt = obj.pipe()
+        good = Shipper(obj.pipe(), {"requests": Sum()})
+
+        logging.disable(logging.CRITICAL)
+        self.addCleanup(logging.disable, logging.NOTSET)
+        obj.start(interval=0.01)
+        bad.ship()
+        corrupt.send_bytes(b"\xff")
+        good.handlers["requests"].emitvalue(2, "index")
+        good.ship()
+        deadline = time.time() + 5
+        while ((total.indices != {"index": 2} or len(obj.connections) > 1)
+                and time.time() < deadline):
+            time.sleep(0.01)
+        self.assertEqual(total.indices, {"index": 2})
+        self.assertTrue(obj.thread.is_alive())
+        self.assertEqual(len(obj.connections), 1)
+        for connection in (bad, good):
+            connection.close()
+        corrupt.close()
+
+    def test_collect_process(self):
+        import multiprocessing
+        from statzlogger import Unique
+        total = Unique()
+        obj = self.init({"users": total})
+        child = multiprocessing.Process(target=ship_users,
+            args=(obj.pipe(), range(100)))
+        child.start()
+        child.join()
+        while obj.connections:
+            obj.collect(timeout=1)
+        self.assertTrue(abs(total.indices["index"] - 100) <= 5)
+
+    def test_collect_listen(self):
+        import multiprocessing.connection
+        import os
+        import tempfile
+        import time
+        from statzlogger import Shipper, Collection
+        total = Collection()
+        obj = self.init({"values": total})
+        address = os.path.join(tempfile.mkdtemp(), "collector")
+        obj.listen(address, "AF_UNIX")
+        obj.start(interval=0.01)
+
+        child = Collection()
+        shipper = Shipper(multiprocessing.connection.Client(address, "AF_UNIX"),
+            {"values": child}, interval=0.01)
+        shipper.start()
+        child.emitvalue(["value"], "index")
+        shipper.close()
+        for i in range(100):
+            if total.indices:
+                break
+            time.sleep(0.01)
+        self.assertEqual(total.indices, {"index": ["value"]})
+
+def ship_users(connection, users):
+    from statzlogger import Shipper, Unique
+    handler = Unique()
+    for user in users:
+        handler.emitvalue(user, "index")
+    Shipper(connection, {"users": handler}).close()
+
+class EmitManyTests(unittest.TestCase):
+
+    def test_emitmany_sum(self):
+        from statzlogger import Sum
+        obj = Sum()
+        obj.emitmany(range(10), index="a", indices=["b"])
+        obj.emitmany(range(10), index="a")
+        obj.emitmany([], index="c")
+        self.assertEqual(obj.indices, {"a": 90, "b": 45})
+
+    @unittest.skipIf(numpy is None, "numpy is not installed")
+    def test_emitcolumns_sum(self):
+        from statzlogger import Sum
+        obj = Sum(ordered=True)
+        obj.emitvalue(1, "a")
+        obj.emitcolumns(["a", "b", "a", None], numpy.array([1, 2, 3, 4]))
+        obj.emitcolumns(numpy.array(["b", "b"]), numpy.array([0.5, 0.25]))
+        obj.emitcolumns(["c"], numpy.array([2 ** 62]))
+        obj.emitcolumns(["c", "c"], numpy.array([2 ** 62, 2 ** 62]))
+        self.assertEqual(obj.indices,
+            {"a": 5, "b": 2.75, "c": 3 * 2 ** 62, None: 4})
+        self.assertEqual([type(obj.indices[index]) for index in "abc"],
+            [int, float, int])
+        self.assertEqual(obj.top(1), [("c", 3 * 2 ** 62)])
+
+    @unittest.skipIf(numpy is None, "numpy is not installed")
+    def test_emitcolumns_sum_dtypes(self):
+        from statzlogger import Sum
+        obj = Sum()
+        obj.emitcolumns(["a", "a"], numpy.array([200, 200], dtype=numpy.uint8))
+        obj.emitcolumns(["b"] * 3, numpy.array([2 ** 31 - 1] * 3,
+            dtype=numpy.int32))
+        obj.emitcolumns(["c", "c"], numpy.array([2 ** 24, 1],
+            dtype=numpy.float32))
+        self.assertEqual(obj.indices,
+            {"a": 400, "b": 3 * (2 ** 31 - 1), "c": 2 ** 24 + 1})
+
+    def test_emitcolumns_sum_op(self):
+        import operator
+        from statzlogger import Sum
+        obj = Sum(default=1, op=operator.mul)
+        obj.emitcolumns(["a", "b", "a"], [2, 3, 4])
+        self.assertEqual(obj.indices, {"a": 8, "b": 3})
+        obj = Sum(default="")
+        obj.emitcolumns(iter(["a", "b", "a"]), "xyz")
+        self.assertEqual(obj.indices, {"a": "xz", "b": "y"})
+
+    def test_emitmany_collection(self):
+        from statzlogger import Collection
+        obj = Collection()
+        obj.emitmany("abc")
+        obj.emitmany("d")
+        self.assertEqual(obj.indices, {None: ["a", "b", "c", "d"]})
+
+    def test_emitmany_collection_prepared(self):
+        from statzlogger import Collection
+
+        class Pairs(Collection):
+            def preparevalue(self, value):
+                return [value, value]
+
+        batched, single = Pairs(), Pairs()
+        batched.emitmany("ab")
+        for value in "ab":
+            single.handle(FakeRecord(value))
+        self.assertEqual(batched.indices, {None: ["a", "a", "b", "b"]})
+        self.assertEqual(batched.indices, single.indices)
+
+    def test_emitmany_collection_op(self):
+        from statzlogger import Collection
+        obj = Collection(default=(), op=lambda x, y: x + tuple(y))
+        obj.emitmany("ab")
+        self.assertEqual(obj.indices, {None: ("a", "b")})
+
+    def test_emitmany_set(self):
+        from statzlogger import Set
+        obj = Set(size=2)
+        obj.emitmany("aab", index="small")
+        obj.emitmany("abc", index="large")
+        self.assertEqual(obj.indices, {"small": set("ab")})
+
+    def test_emitmany_maximum(self):
+        import random
+        from statzlogger import Maximum
+        rand = random.Random(0)
+        values = [rand.randint(0, 50) for i in range(500)]
+        batched = Maximum(size=5, weight=lambda value: value % 7)
+        batched.emitmany(values)
+        single = Maximum(size=5, weight=lambda value: value % 7)
+        for value in values:
+            single.emitvalue([(value, value % 7)], None)
+        self.assertEqual(batched.indices, single.indices)
+
+    def test_emitmany_top(self):
+        from statzlogger import Top
+        obj = Top(size=2)
+        obj.emitmany("aaabbc")
+        self.assertEqual(obj.indices[None][0], ("a", 3))
+
+    def test_emitrecords(self):
+        from statzlogger import Sum
+        obj = Sum()
+        obj.emitrecords(FakeRecord(i, extra=dict(index=i % 2)) for i in range(10))
+        self.assertEqual(obj.indices, {0: 20, 1: 25})
+
+class SummaryTests(unittest.TestCase):
+
+    def cls(self):
+        from statzlogger import Summary as cls
+        return cls
+
+    def init(self, *args, **kwargs):
+        return self.cls()(*args, **kwargs)
+
+    def test_emitvalue(self):
+        obj = self.init()
+        for value in (3, 1, 2):
+            obj.emitvalue(value, "index")
+
+        self.assertEqual(obj.indices["index"],
+            dict(count=3, sum=6, mean=2.0, min=1, max=3))
+
+    def test_emitmany(self):
+        obj = self.init()
+        obj.emitvalue(10, "index")
+        obj.emitmany([1, 2, 3], "index")
+        self.assertEqual(obj.indices["index"],
+            dict(count=4, sum=16, mean=4.0, min=1, max=10))
+
+    def test_emitcolumns(self):
+        obj = self.init()
+        obj.emitcolumns(["a", "b", "a", None], [1, 2, 3, 4])
+        self.assertEqual(obj.indices["a"],
+            dict(count=2, sum=4, mean=2.0, min=1, max=3))
+        self.assertEqual(obj.indices[None]["count"], 1)
+
+    def test_mergevalue(self):
+        obj = self.init()
+        other = self.init()
+        obj.emitmany([1, 2], "index")
+        other.emitmany([0, 5], "index")
+        obj.merge(other)
+        self.assertEqual(obj.indices["index"],
+            dict(count=4, sum=8, mean=2.0, min=0, max=5))
+
+    @unittest.skipIf(numpy is None, "numpy is not installed")
+    def test_numeric_table(self):
+        from statzlogger import NumericTable
+        obj = self.init()
+        self.assertTrue(isinstance(obj.data, NumericTable))
+        obj.emitcolumns([i % 100 for i in range(1000)], range(1000))
+        self.assertEqual(len(obj.indices), 100)
+        self.assertEqual(obj.indices[0]["sum"], sum(range(0, 1000, 100)))
+        del obj.data[0]
+        self.assertEqual(obj.indices[99]["max"], 999)
+
+    @unittest.skipIf(numpy is None, "numpy is not installed")
+    def test_maximum_candidates(self):
+        from statzlogger import Maximum
+        obj = Maximum(size=2, weight=lambda value: value % 3)
+        obj.emitmany(range(20))
+        self.assertEqual(obj.indices[None], [(2, 2), (5, 2)])
+
+class WindowTests(unittest.TestCase):
+
+    def cls(self):
+        from statzlogger import Window as cls
+        return cls
+
+    def init(self, *args, **kwargs):
+        return self.cls()(*args, **kwargs)
+
+    def record(self, msg, created):
+        return FakeRecord(msg, extra=dict(created=created))
+
+    def test_emit_sliding(self):
+        from statzlogger import Sum
+        obj = self.init(Sum(), interval=10, size=3)
+        for created in (0, 5, 15, 25, 35):
+            obj.handle(self.record(1, created))
+
+        self.assertEqual(obj.query(now=35), {None: 3})
+        self.assertEqual(obj.query(span=10, now=35), {None: 1})
+        self.assertEqual(obj.query(span=15, now=39), {None: 2})
+        self.assertEqual(obj.query(now=65), {})
+
+    def test_emit_tumbling(self):
+        from statzlogger import Maximum
+        obj = self.init(Maximum(size=1), interval=10)
+        obj.handle(self.record("old", 5))
+        obj.handle(self.record("new", 12))
+        self.assertEqual(obj.query(now=12), {None: [("new", 1)]})
+
+    def test_emit_late(self):
+        from statzlogger import Collection
+        obj = self.init(Collection(), interval=10, size=2)
+        obj.handle(self.record("current", 25))
+        obj.handle(self.record("late", 5))
+        self.assertEqual(obj.query(now=25), {None: ["current"]})
+
+    def test_emitmany(self):
+        from statzlogger import Sum
+        obj = self.init(Sum(), interval=60, size=5)
+        obj.emitmany([1, 2, 3], index="index")
+        self.assertEqual(obj.indices, {"index": 6})
+        self.assertEqual(obj.swapdata(), {"index": 6})
+        self.assertEqual(obj.indices, {})
+
+class EvictionTests(unittest.TestCase):
+
+    def emit(self, obj, value, index):
+        obj.emit(FakeRecord(value, extra=dict(index=index)))
+
+    def test_evict_lru(self):
+        from statzlogger import Sum
+        evicted = []
+        obj = Sum(maxindices=2, onevict=lambda *args: evicted.append(args))
+        self.emit(obj, 1, "a")
+        self.emit(obj, 1, "b")
+        self.emit(obj, 1, "a")
+        self.emit(obj, 5, "c")
+        self.assertEqual(obj.indices, {"a": 2, "c": 5})
+        self.assertEqual(evicted, [("b", 1)])
+        self.assertEqual(obj.evicted, 1)
+
+    def test_evict_lfu(self):
+        from statzlogger import Collection
+        obj = Collection(maxindices=2, eviction="lfu")
+        for index in "aaabbc":
+            self.emit(obj, index, index)
+        self.assertEqual(sorted(obj.indices), ["a", "c"])
+        self.emit(obj, "d", "d")
+        self.assertEqual(sorted(obj.indices), ["a", "d"])
+
+    def test_evict_weight(self):
+        from statzlogger import Sum
+        obj = Sum(maxindices=2, eviction="weight")
+        self.emit(obj, 1, "a")
+        self.emit(obj, 3, "b")
+        self.emit(obj, 5, "a")
+        self.emit(obj, 4, "c")
+        self.assertEqual(obj.indices, {"a": 6, "c": 4})
+
+    def test_evict_many(self):
+        from statzlogger import Maximum
+        obj = Maximum(maxindices=10)
+        for i in range(1000):
+            self.emit(obj, i, i)
+        self.assertEqual(sorted(obj.indices), list(range(990, 1000)))
+        self.assertEqual(obj.evicted, 990)
+
+    def test_evict_set_size(self):
+        from statzlogger import Set
+        obj = Set(size=1, maxindices=1, eviction="weight")
+        self.emit(obj, ["a", "b"], "large")
+        self.emit(obj, "a", "small")
+        self.assertEqual(obj.indices, {"small": set(["a"])})
+
+    def test_evict_emitmany(self):
+        from statzlogger import Sum
+        obj = Sum(maxindices=1)
+        obj.emitmany([1, 2], index="a")
+        obj.emitmany([3], index="b")
+        self.assertEqual(obj.indices, {"b": 3})
+
+    def test_evict_invalid(self):
+        from statzlogger import Sum
+        self.assertRaises(ValueError, Sum, maxindices=1, eviction="random")
+
+class StreamTests(unittest.TestCase):
+
+    def roundtrip(self, obj, other=None):
+        import io
+        stream = io.BytesIO()
+        obj.dump(stream)
+        if other is None:
+            other = obj.clone()
+        stream.seek(0)
+        other.load(stream)
+        return other
+
+    def test_decode_truncated(self):
+        import io
+        from statzlogger import decode, encode
+        for value in (2.5, "a string", b"some bytes", [1, 2.5]):
+            stream = io.BytesIO()
+            encode(value, stream.write)
+            data = stream.getvalue()
+            for end in range(len(data)):
+                self.assertRaises(EOFError, decode, io.BytesIO(data[:end]).read)
+
+    def test_encode(self):
+        import io
+        from statzlogger import encode, decode
+        values = [None, True, False, 0, -1, 2 ** 70, -2 ** 70, 1.5, "\u00e9",
+            b"\x00\xff", (1, "a"), [1, [2]], set([1]), frozenset([2]),
+            {"a": (1, 2.0), None: {}}]
+        stream = io.BytesIO()
+        for value in values:
+            encode(value, stream.write)
+        stream.seek(0)
+        self.assertEqual([decode(stream.read) for value in values], values)
+
+    def test_encode_unsupported(self):
+        from statzlogger import encode
+        self.assertRaises(TypeError, encode, object(), lambda data: None)
+
+    def test_roundtrip_handlers(self):
+        from statzlogger import (Sum, Collection, Maximum, Minimum, Set, Top,
+            Unique, Quantile, Summary)
+        for cls in (Sum, Collection, Maximum, Minimum, Set, Top, Unique,
+                Quantile, Summary):
+            obj = cls()
+            for i in range(1, 50):
+                obj.handle(FakeRecord(i, extra=dict(index=i % 3)))
+            self.assertEqual(dict(self.roundtrip(obj).indices),
+                dict(obj.indices), cls.__name__)
+
+    def test_load_merges(self):
+        from statzlogger import Maximum
+        obj = Maximum(size=2)
+        obj.emitvalue([("a", 1), ("b", 3)], "index")
+        other = Maximum(size=2)
+        other.emitvalue([("c", 2)], "index")
+        self.roundtrip(obj, other)
+        self.assertEqual(other.indices, {"index": [("b", 3), ("c", 2)]})
+
+    def test_load_streaming(self):
+        import io
+        from statzlogger import Sum, readstream
+        obj = Sum()
+        for i in range(3):
+            obj.emitvalue(i, i)
+        stream = io.BytesIO()
+        obj.dump(stream, reset=True)
+        self.assertEqual(obj.indices, {})
+        stream.seek(0)
+        kind, records = readstream(stream)
+        self.assertEqual(kind, "Sum")
+        self.assertEqual(next(records), (0, 0))
+        self.assertEqual(list(records), [(1, 1), (2, 2)])
+
+    def test_load_kind(self):
+        import io
+        from statzlogger import Maximum, Minimum
+        stream = io.BytesIO()
+        Maximum().dump(stream)
+        stream.seek(0)
+        self.assertRaises(ValueError, Minimum().load, stream)
+
+    def test_load_version(self):
+        import io
+        from statzlogger import Sum
+        self.assertRaises(ValueError, Sum().load, io.BytesIO(b"SZL\x63"))
+        self.assertRaises(ValueError, Sum().load, io.BytesIO(b"pickle"))
+
+class MappedStorageTests(unittest.TestCase):
+
+    def path(self):
+        import os
+        import shutil
+        import tempfile
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        return os.path.join(directory, "indices")
+
+    def test_sum_restart(self):
+        from statzlogger import MappedSlots, Sum
+        path = self.path()
+        obj = Sum(storage=MappedSlots(path))
+        for i in range(200):
+            obj.emitvalue(0.5, i % 100)
+        obj.emitvalue(1, ("tuple", None))
+        obj.close()
+
+        obj = Sum(storage=MappedSlots(path))
+        self.assertEqual(len(obj.indices), 101)
+        self.assertEqual(obj.indices[99], 1.0)
+        self.assertEqual(obj.indices[("tuple", None)], 1.0)
+        obj.close()
+
+    def test_sum_integers(self):
+        from statzlogger import MappedSlots, Sum
+        path = self.path()
+        obj = Sum(storage=MappedSlots(path, typecode="q"))
+        obj.emitvalue(2 ** 40, "index")
+        del obj.data["index"]
+        obj.emitvalue(3, "other")
+        obj.close()
+
+        storage = MappedSlots(path, typecode="q")
+        self.assertEqual(dict(storage), {"other": 3})
+        storage.close()
+        self.assertRaises(ValueError, MappedSlots, path, "d")
+
+    def test_sum_snapshot_reset(self):
+        from statzlogger import MappedSlots, Sum
+        path = self.path()
+        obj = Sum(storage=MappedSlots(path))
+        obj.emitvalue(1, "index")
+        self.assertEqual(obj.snapshot(reset=True), {"index": 1.0})
+        obj.emitvalue(2, "other")
+        self.assertEqual(obj.indices, {"other": 2.0})
+        obj.close()
+
+        obj = Sum(storage=MappedSlots(path))
+        self.assertEqual(obj.indices, {"other": 2.0})
+        obj.close()
+
+    def test_truncated_files(self):
+        import os
+        from statzlogger import Collection, MappedLists, MappedSlots, Sum
+        path = self.path()
+        obj = Collection(storage=MappedLists(path))
+        obj.emitvalue([1, "two"], "a")
+        obj.emitvalue([2.5], "a")
+        obj.close()
+        os.truncate(path, os.path.getsize(path) - 3)
+        obj = Collection(storage=MappedLists(path))
+        self.assertEqual(obj.indices["a"], [1, "two"])
+        obj.close()
+
+        path = self.path()
+        obj = Sum(storage=MappedSlots(path))
+        obj.emitvalue(1, "a")
+        obj.emitvalue(2, 1.5)
+        obj.close()
+        os.truncate(path + ".keys", os.path.getsize(path + ".keys") - 3)
+        obj = Sum(storage=MappedSlots(path))
+        self.assertEqual(obj.indices, {"a": 1.0})
+        obj.close()
+
+        path = self.path()
+        obj = Sum(storage=MappedSlots(path))
+        obj.emitvalue(1, "a")
+        obj.emitvalue(2, "a long index name")
+        obj.close()
+        os.truncate(path + ".keys", os.path.getsize(path + ".keys") - 3)
+        obj = Sum(storage=MappedSlots(path))
+        self.assertEqual(obj.indices, {"a": 1.0})
+        obj.close()
+
+    def test_set_restart(self):
+        from statzlogger import MappedLists, Set
+        path = self.path()
+        obj = Set(storage=MappedLists(path), size=3)
+        for value in "abab":
+            obj.handle(FakeRecord(value, dict(index="x")))
+        for value in "pqrs":
+            obj.handle(FakeRecord(value, dict(index="y")))
+        self.assertEqual(obj.indices, dict(x=set("ab")))
+        obj.close()
+
+        obj = Set(storage=MappedLists(path))
+        self.assertEqual(obj.indices, dict(x=set("ab")))
+        self.assertEqual(len(obj.data["x"]), 2)
+        obj.handle(FakeRecord("c", dict(index="x")))
+        obj.handle(FakeRecord("a", dict(index="x")))
+        self.assertEqual(obj.snapshot(reset=True), dict(x=set("abc")))
+        self.assertEqual(obj.indices, {})
+        obj.close()
+
+    def test_collection_restart(self):
+        from statzlogger import Collection, MappedLists
+        path = self.path()
+        obj = Collection(storage=MappedLists(path))
+        obj.emitvalue(["value", 1], "a")
+        obj.emitvalue([(2, 3.0)], "b")
+        obj.emitvalue([None], "a")
+        self.assertEqual(obj.indices["a"], ["value", 1, None])
+        obj.close()
+
+        obj = Collection(storage=MappedLists(path))
+        self.assertEqual(obj.indices, {"a": ["value", 1, None], "b": [(2, 3.0)]})
+        self.assertEqual(obj.snapshot(reset=True)["b"], [(2, 3.0)])
+        obj.emitvalue([4], "b")
+        obj.close()
+
+        obj = Collection(storage=MappedLists(path))
+        self.assertEqual(obj.indices, {"b": [4]})
+        obj.close()
+
+
+class ExporterTests(unittest.TestCase):
+
+    def handlers(self):
+        from statzlogger import Sum, Summary
+        sum, summary = Sum(), Summary()
+        for user, size in (("a", 1), ("a", 2), ("b", 5)):
+            record = FakeRecord(size, dict(index=user))
+            sum.handle(record)
+            summary.handle(record)
+        return dict(sum=sum, summary=summary)
+
+    def test_export_callable(self):
+        from statzlogger import Exporter
+        batches = []
+        handlers = self.handlers()
+        exporter = Exporter(handlers, [batches.append])
+        exporter.export()
+        exporter.export()
+
+        self.assertEqual(len(batches), 2)
+        exported = dict((name, dict(snapshot))
+            for name, handler, snapshot in batches[0])
+        self.assertEqual(exported["sum"], dict(a=3, b=5))
+        self.assertEqual(exported["summary"]["a"]["max"], 2)
+        self.assertEqual(dict(batches[1][0][2]), {})
+
+    def test_export_retry(self):
+        from statzlogger import Exporter
+        batches = []
+        def flaky(batch):
+            if not batches:
+                batches.append(None)
+                raise IOError("down")
+            batches.append(dict(batch[0][2]))
+        exporter = Exporter(dict(sum=self.handlers()["sum"]), [flaky])
+        import logging
+        logging.disable(logging.CRITICAL)
+        try:
+            exporter.export(now=0)
+        finally:
+            logging.disable(logging.NOTSET)
+        exporter.export(now=0.5)
+        self.assertEqual(batches, [None])
+        exporter.export(now=2)
+        self.assertEqual(batches, [None, dict(a=3, b=5), {}, {}])
+
+    def test_file_json(self):
+        import json, os, tempfile
+        from statzlogger import Exporter, FileSink
+        path = os.path.join(tempfile.mkdtemp(), "export.json")
+        sink = FileSink(path)
+        Exporter(self.handlers(), [sink]).close()
+        sink.close()
+        lines = [json.loads(line) for line in open(path)]
+        values = dict(((line["handler"], line["index"]), line["value"])
+            for line in lines)
+        self.assertEqual(values["sum", "b"], 5)
+        self.assertEqual(values["summary", "a"]["count"], 2)
+
+    def test_file_binary(self):
+        import os, tempfile
+        from statzlogger import Exporter, FileSink, Sum
+        path = os.path.join(tempfile.mkdtemp(), "export.szl")
+        handlers = self.handlers()
+        sink = FileSink(path, format="binary")
+        Exporter(dict(sum=handlers["sum"]), [sink]).close()
+        sink.close()
+
+        obj = Sum()
+        with open(path, "rb") as fileobj:
+            from statzlogger import decode
+            self.assertEqual(decode(fileobj.read), "sum")
+            obj.load(fileobj)
+        self.assertEqual(dict(obj.indices), dict(a=3, b=5))
+
+    def test_statsd(self):
+        import socket
+        from statzlogger import Exporter, StatsdSink
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(("127.0.0.1", 0))
+        server.settimeout(5)
+        sink = StatsdSink(server.getsockname(), prefix="app")
+        Exporter(self.handlers(), [sink]).export()
+        lines = set(server.recv(65536).decode("utf-8").split("\n"))
+        sink.close()
+        server.close()
+        self.assertTrue("app.sum.a:3|g" in lines)
+        self.assertTrue("app.summary.b.mean:5.0|g" in lines)
+
+    def test_thread(self):
+        from statzlogger import Exporter
+        batches = []
+        exporter = Exporter(self.handlers(), [batches.append], interval=0.01)
+        exporter.start()
+        import time
+        time.sleep(0.05)
+        exporter.close()
+        self.assertTrue(len(batches) >= 2)
+        self.assertEqual(exporter.handlers["sum"].indices, {})
+
+class CounterTests(unittest.TestCase):
+
+    def test_sum(self):
+        from statzlogger import Sum
+        obj = Sum()
+        hits = obj.counter("hits")
+        hits()
+        hits(5)
+        obj.handle(FakeRecord(2, dict(index="hits")))
+        self.assertEqual(obj.indices, dict(hits=8))
+
+    def test_sum_snapshot(self):
+        from statzlogger import Sum
+        obj = Sum()
+        hits = obj.counter("hits")
+        hits()
+        self.assertEqual(dict(obj.snapshot(reset=True)), dict(hits=1))
+        hits()
+        hits()
+        self.assertEqual(obj.indices, dict(hits=2))
+
+    def test_maxindices(self):
+        from statzlogger import Sum
+        obj = Sum(maxindices=1)
+        obj.counter("a")()
+        obj.counter("b")(2)
+        self.assertEqual(obj.indices, dict(b=2))
+        self.assertEqual(obj.evicted, 1)
+
+    def test_collection(self):
+        from statzlogger import Collection
+        obj = Collection()
+        add = obj.counter("a")
+        add("x")
+        add("y")
+        self.assertEqual(obj.indices, dict(a=["x", "y"]))
+
+    def test_sharded(self):
+        import threading
+        from statzlogger import Sharded, Sum
+        obj = Sharded(Sum())
+        hits = obj.counter("hits")
+        threads = [threading.Thread(target=lambda: [hits() for i in range(100)])
+            for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(obj.indices, dict(hits=400))
+
+    def test_window(self):
+        from statzlogger import Sum, Window
+        obj = Window(Sum(), interval=60, size=2)
+        obj.counter("hits")(3)
+        self.assertEqual(obj.indices, dict(hits=3))
+
+class DimensionTests(unittest.TestCase):
+
+    def init(self, cls=None, **kwargs):
+        from statzlogger import Sum
+        obj = (cls or Sum)(dimensions=("method", "path", "status"), **kwargs)
+        for method, path, status, value in (
+                ("GET", "/api", 200, 1),
+                ("GET", "/api", 500, 2),
+                ("POST", "/api", 503, 4),
+                ("GET", "/static", 500, 8),
+                ("GET", "/static", 200, 16)):
+            obj.handle(FakeRecord(value,
+                dict(method=method, path=path, status=status)))
+        return obj
+
+    def test_indices(self):
+        obj = self.init()
+        self.assertEqual(len(obj.indices), 5)
+        self.assertEqual(obj.indices["POST", "/api", 503], 4)
+
+    def test_missing_dimension(self):
+        from statzlogger import Sum
+        obj = Sum(dimensions=("method", "path"))
+        obj.handle(FakeRecord(1, dict(method="GET")))
+        self.assertEqual(obj.indices, {("GET", None): 1})
+
+    def test_rollup(self):
+        obj = self.init()
+        self.assertEqual(obj.rollup(), {(): 31})
+        self.assertEqual(obj.rollup(by=["path"]),
+            {("/api",): 7, ("/static",): 24})
+        self.assertEqual(obj.rollup(by=["path", "method"]),
+            {("/api", "GET"): 3, ("/api", "POST"): 4, ("/static", "GET"): 24})
+
+    def test_rollup_where(self):
+        obj = self.init()
+        self.assertEqual(obj.rollup(by=["path"],
+                where=dict(status=lambda status: status >= 500)),
+            {("/api",): 6, ("/static",): 8})
+        self.assertEqual(obj.rollup(where=dict(path="/api", method="GET")),
+            {(): 3})
+
+    def test_rollup_copies(self):
+        from statzlogger import Collection
+        obj = self.init(Collection)
+        self.assertEqual(sorted(obj.rollup(by=["path"])["/api",]), [1, 2, 4])
+        self.assertEqual(obj.indices["GET", "/api", 200], [1])
+
+    def test_rollup_errors(self):
+        from statzlogger import Sum
+        self.assertRaises(ValueError, Sum().rollup)
+        self.assertRaises(ValueError, self.init().rollup, by=["host"])
+
+class InstrumentationTests(unittest.TestCase):
+
+    def test_metrics_plain(self):
+        from statzlogger import Collection
+        obj = Collection(maxindices=2)
+        for index in "abc":
+            obj.handle(FakeRecord(index * 100, dict(index=index)))
+        metrics = obj.metrics()
+        self.assertEqual(metrics["indices"], 2)
+        self.assertEqual(metrics["evicted"], 1)
+        self.assertEqual(metrics["dropped"], 0)
+        self.assertTrue(metrics["bytes"] > 200)
+        self.assertFalse("handled" in metrics)
+        self.assertFalse("handle" in obj.__dict__)
+
+    def test_instrument(self):
+        from statzlogger import Sum
+        obj = Sum()
+        obj.instrument(sample=10)
+        for i in range(25):
+            obj.handle(FakeRecord(1))
+        metrics = obj.metrics()
+        self.assertEqual(obj.indices, {None: 25})
+        self.assertEqual(metrics["handled"], 25)
+        self.assertEqual(metrics["sampled"], 2)
+        self.assertTrue(metrics["emittime"] > 0)
+        self.assertTrue(metrics["lockwait"] >= 0)
+
+        obj.instrument(None)
+        self.assertFalse("handle" in obj.__dict__)
+        self.assertFalse("handled" in obj.metrics())
+
+    def test_clone(self):
+        from statzlogger import Sum
+        obj = Sum()
+        obj.instrument(sample=1)
+        clone = obj.clone()
+        clone.handle(FakeRecord(1))
+        self.assertEqual(obj.metrics()["handled"], 0)
+        self.assertEqual(clone.metrics()["handled"], 1)
+        self.assertEqual(obj.indices, {})
+
+    def test_clone_filters(self):
+        from statzlogger import Sum
+        obj = Sum()
+        clone = obj.clone()
+        clone.addFilter(lambda record: False)
+        obj.handle(FakeRecord(1))
+        self.assertEqual(obj.indices, {None: 1})
+
+    def test_export(self):
+        from statzlogger import Exporter, Sum
+        obj = Sum()
+        obj.instrument(sample=1)
+        obj.handle(FakeRecord(1))
+        batches = []
+        Exporter(dict(sum=obj), [batches.append], metrics=True).export()
+        exported = dict((name, dict(snapshot))
+            for name, handler, snapshot in batches[0])
+        self.assertEqual(exported["sum"], {None: 1})
+        self.assertEqual(exported["sum.metrics"]["handled"], 1)
+
+class SamplingTests(unittest.TestCase):
+
+    def setUp(self):
+        import random
+        random.seed(1)
+
+    def test_sum_estimate(self):
+        from statzlogger import Sum
+        obj = Sum(rate=0.1)
+        for i in range(20000):
+            obj.handle(FakeRecord(1))
+        self.assertTrue(abs(obj.indices[None] - 20000) < 1000)
+
+    def test_rejected_before_getvalue(self):
+        from statzlogger import Sum
+        calls = []
+        class Counting(Sum):
+            def getvalue(self, record):
+                calls.append(record)
+                return Sum.getvalue(self, record)
+        obj = Counting(rate=0.5)
+        for i in range(1000):
+            obj.handle(FakeRecord(1))
+        self.assertTrue(400 < len(calls) < 600)
+
+    def test_full_rate(self):
+        from statzlogger import Collection, Sum
+        obj = Sum(rate=1.0)
+        obj.handle(FakeRecord(3))
+        self.assertEqual(obj.indices, {None: 3})
+        obj = Collection(rate=0.5)
+        for i in range(10):
+            obj.handle(FakeRecord(2))
+        self.assertEqual(set(obj.indices[None]), set([2]))
+
+    def test_adaptive(self):
+        from statzlogger import Sampler
+        sampler = Sampler(target=100, interval=1.0)
+        for i in range(2001):
+            record = FakeRecord(1, dict(created=i / 1000.0))
+            sampler.filter(record)
+        self.assertAlmostEqual(sampler.rate, 0.1, places=3)
+
+    def test_wrappers(self):
+        import time
+        from statzlogger import Async, Queued, Sharded, Sum, Window
+        window = lambda handler: Window(handler, interval=3600, size=2)
+        for wrapper in (Queued, Async, Sharded, window):
+            obj = wrapper(Sum(rate=0.5))
+            for i in range(4000):
+                obj.handle(FakeRecord(1, dict(created=time.time())))
+            obj.flush()
+            self.assertTrue(abs(obj.indices[None] - 4000) < 400,
+                (wrapper, obj.indices[None]))
+            obj.close()
+
+    def test_record_rate(self):
+        from statzlogger import Sum
+        obj = Sum(rate=0.5)
+        record = FakeRecord(1)
+        self.assertEqual(obj.getvalue(record), 1)
+        record.samplerate = 0.25
+        obj.sampler.rate = 0.5
+        self.assertEqual(obj.getvalue(record), 4)
+        self.assertEqual(Sum().getvalue(record), 1)
+
+    def test_rate_errors(self):
+        from statzlogger import Sum
+        self.assertRaises(ValueError, Sum, rate=0)
+        self.assertRaises(ValueError, Sum, rate=1.5)
+
+class SampleTests(unittest.TestCase):
+
+    def setUp(self):
+        import random
+        random.seed(1)
+
+    def test_emit(self):
+        from statzlogger import Sample
+        obj = Sample(size=10)
+        for i in range(1000):
+            obj.handle(FakeRecord(i))
+        values = obj.indices[None]
+        self.assertEqual(len(values), 10)
+        self.assertTrue(max(values) >= 100)
+
+    def test_small(self):
+        from statzlogger import Sample
+        obj = Sample(size=10)
+        obj.emitmany([1, 2, 3], index="a")
+        self.assertEqual(obj.indices["a"], [1, 2, 3])
+
+    def test_uniform(self):
+        from statzlogger import Sample
+        hits = [0] * 10
+        for trial in range(2000):
+            obj = Sample(size=1)
+            obj.emitmany(range(10))
+            hits[obj.indices[None][0]] += 1
+        self.assertTrue(min(hits) > 140 and max(hits) < 260)
+
+    def test_merge(self):
+        from statzlogger import Sample
+        first, second = Sample(size=10), Sample(size=10)
+        first.emitmany([0] * 900)
+        second.emitmany([1] * 100)
+        counts = [0, 0]
+        for trial in range(200):
+            merged = first.clone()
+            merged.merge(first)
+            merged.merge(second)
+            for value in merged.indices[None]:
+                counts[value] += 1
+        self.assertEqual(sum(counts), 2000)
+        self.assertTrue(100 < counts[1] < 300)
+
+    def test_dump(self):
+        import io
+        from statzlogger import Sample
+        obj = Sample(size=5)
+        obj.emitmany(range(100), index="a")
+        stream = io.BytesIO()
+        obj.dump(stream)
+        stream.seek(0)
+        other = Sample(size=5)
+        other.load(stream)
+        self.assertEqual(other.indices["a"], obj.indices["a"])
+        self.assertEqual(other.data["a"].seen, 100)
+
+class QueryTests(unittest.TestCase):
+
+    def fill(self, obj):
+        import random
+        rng = random.Random(7)
+        for i in range(2000):
+            obj.handle(FakeRecord(rng.randint(-5, 20),
+                dict(index=rng.randint(0, 99))))
+        return obj
+
+    def test_matches_scan(self):
+        from statzlogger import Sum
+        ordered, plain = self.fill(Sum(ordered=True)), self.fill(Sum())
+        self.assertTrue(len(ordered.order.heap) <= 2 * 100 + 64)
+        self.assertEqual(ordered.total(), plain.total())
+        self.assertEqual(ordered.total(), sum(plain.indices.values()))
+        expected = sorted(plain.indices.items(), key=lambda item: -item[1])
+        self.assertEqual([value for index, value in ordered.top(10)],
+            [value for index, value in expected[:10]])
+        even = lambda index: index % 2 == 0
+        self.assertEqual(dict(ordered.top(5, where=even)),
+            dict(plain.top(5, where=even)))
+        self.assertEqual(ordered.select(minimum=100),
+            plain.select(minimum=100))
+        self.assertEqual(ordered.select(where=even), plain.select(where=even))
+
+    def test_top_ties(self):
+        from statzlogger import Sum
+        obj = Sum(ordered=True)
+        for index in "abc":
+            obj.handle(FakeRecord(1, dict(index=index)))
+        obj.handle(FakeRecord(2, dict(index="d")))
+        self.assertEqual(obj.top(3), [("d", 2), ("a", 1), ("b", 1)])
+        self.assertEqual(obj.top(10), [("d", 2), ("a", 1), ("b", 1),
+            ("c", 1)])
+
+    def test_set_sizes(self):
+        from statzlogger import Set
+        obj = Set(ordered=True, size=2)
+        obj.emitmany("ab", index="x")
+        obj.emitmany("a", index="y")
+        self.assertEqual(obj.top(1), [("x", set("ab"))])
+        self.assertEqual(obj.total(), 3)
+        obj.handle(FakeRecord("c", dict(index="x")))
+        self.assertEqual(obj.top(), [("y", set("a"))])
+        self.assertEqual(obj.total(), 1)
+
+    def test_eviction_and_reset(self):
+        from statzlogger import Sum
+        obj = Sum(ordered=True, maxindices=2)
+        obj.counter("a")(5)
+        obj.counter("b")(3)
+        obj.counter("c")(1)
+        self.assertEqual(obj.top(), [("b", 3), ("c", 1)])
+        self.assertEqual(obj.total(), 4)
+        obj.snapshot(reset=True)
+        self.assertEqual(obj.top(), [])
+        self.assertEqual(obj.total(), 0)
+
+    def test_unique_weights(self):
+        import time
+        from statzlogger import Unique
+        obj = Unique(ordered=True)
+        began = time.time()
+        for i in range(5000):
+            obj.handle(FakeRecord(i, dict(index=i % 2)))
+        self.assertTrue(time.time() - began < 1)
+        self.assertEqual(obj.total(), obj.indices[0] + obj.indices[1])
+        self.assertTrue(abs(obj.total() - 5000) < 250)
+
+        for estimator in obj.data.values():
+            harmonic, zeros = estimator.harmonic, estimator.zeros
+            estimator.recount()
+            self.assertAlmostEqual(estimator.harmonic, harmonic)
+            self.assertEqual(estimator.zeros, zeros)
+
+    def test_merge_and_wrappers(self):
+        from statzlogger import Sharded, Sum
+        obj = Sum(ordered=True)
+        other = Sum()
+        other.emitmany([1, 2], index="a")
+        obj.merge(other)
+        self.assertEqual(obj.top(), [("a", 3)])
+        wrapper = Sharded(Sum())
+        wrapper.handle(FakeRecord(4, dict(index="b")))
+        self.assertEqual(wrapper.top(), [("b", 4)])
+        self.assertEqual(wrapper.total(), 4)
 
 if __name__ == "__main__":
     unittest.main()